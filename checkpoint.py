@@ -0,0 +1,103 @@
+# checkpoints of finished cognate sets, so that long runs can be resumed
+# pylexemes
+
+import os, time
+from helpers import CheckpointError
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+FORMAT_VERSION = 1
+
+class Checkpoint:
+    '''Keeps the results of finished cognate sets in a file, one JSON line per set:
+    the provisional reconstruction and the forms kept from the first pass,
+    and the final reconstruction from the second. Lines are only appended,
+    and the file is flushed every so many sets or seconds, so keeping it costs
+    about as much as printing the reconstructions.
+
+    The first line identifies the dataset and the segment inventory, and a checkpoint
+    for anything else can't be resumed from. If the number of best reconstructions
+    has changed since, only the second pass has to be done again.'''
+
+    def __init__(self, filename, key, n_best=None, resume=False, every=50, interval=10.0):
+        self.filename = filename
+        self.key = key
+        self.n_best = n_best
+        self.every = every
+        self.interval = interval
+        # number of the set -> (provisional reconstruction, kept forms, final reconstruction, n_best)
+        self.records = {}
+
+        if resume and os.path.exists(filename):
+            end = self._load()
+            # anything after the last whole line was cut off in the middle of being written
+            os.truncate(filename, end)
+            self.file = open(filename, 'a', encoding='utf-8')
+        else:
+            self.file = open(filename, 'w', encoding='utf-8')
+            self.file.write(json.dumps({'format': FORMAT_VERSION, 'key': key}) + '\n')
+            self.file.flush()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def _load(self):
+        '''Reads the finished sets and returns where the last whole line ends'''
+        with open(self.filename, 'rb') as f:
+            header = f.readline()
+            try:
+                header = json.loads(header.decode('utf-8'))
+            except ValueError:
+                raise CheckpointError('{} is not a checkpoint'.format(self.filename))
+            if header.get('format') != FORMAT_VERSION or header.get('key') != self.key:
+                raise CheckpointError('The checkpoint was made for a different dataset or segment inventory')
+            end = f.tell()
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                # a set can be there more than once if a run was resumed with a different n_best
+                self.records[record['n']] = (record['prov'], record['kept'], record['rec'], record['k'])
+                end += len(line)
+        return end
+
+    def done(self, n):
+        '''The final reconstruction of set number n, if it's done with the current settings'''
+        record = self.records.get(n)
+        if record is None or record[3] != self.n_best:
+            return None
+        return record[2]
+
+    def first_pass(self, n):
+        '''The provisional reconstruction and the kept forms of set number n, if it got that far'''
+        record = self.records.get(n)
+        if record is None:
+            return None
+        return (record[0], record[1])
+
+    def add(self, n, prov_rec, kept, rec):
+        self.records[n] = (prov_rec, kept, rec, self.n_best)
+        self.file.write(json.dumps({'n': n, 'prov': prov_rec, 'kept': kept,
+                                    'rec': rec, 'k': self.n_best},
+                                   separators=(',', ':')) + '\n')
+        self.pending += 1
+        if self.pending >= self.every or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+        '''Closes and deletes the checkpoint once the run is finished'''
+        self.close()
+        os.remove(self.filename)
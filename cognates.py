@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# finding cognate sets in glossed word lists
+# pylexemes
+
+import argparse, heapq, random
+from collections import Counter, defaultdict
+from helpers import SegmentParser, Form, CognateSet, form_bits, edit_ratio
+from lexemestore import LexemeStore, is_db_file
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import numpy as np
+except ImportError:
+    from warnings import warn
+    warn('numpy not found. Word signatures will be worked out one by one, which is much slower.')
+    np = None
+
+# the features that are left out when hashing segments, so that words
+# still end up in the same buckets after changes like voicing, lenition or aspiration
+VOLATILE_FEATURES = ('voice', 'cont', 'SG', 'CG', 'del_rel', 'strident', 'tense', 'ATR')
+
+# the hash functions are (a * x + b) mod this prime
+PRIME = (1 << 31) - 1
+
+def read_word_lists(filename):
+    '''Reads (lang_name, lang_code, [(gloss, form), ...]) for each language
+    from a lexeme database or from a JSON file in the same format as the lexemes file,
+    where every language has glosses of its own'''
+    if is_db_file(filename):
+        store = LexemeStore(filename)
+        word_lists = store.word_lists()
+        store.close()
+    else:
+        word_lists = []
+        for entry in json.load(open(filename)):
+            forms = entry['forms']
+            if isinstance(forms, str):
+                forms = [form.strip() for form in forms.split(',')]
+            glosses = entry.get('glosses', [str(n) for n in range(1, len(forms) + 1)])
+            word_lists.append((entry['lang_name'], entry['lang_code'], list(zip(glosses, forms))))
+    # the key has nothing to do with finding cognates
+    return [(lang_name, lang_code, [(gloss, form) for gloss, form in words if form != '-'])
+                for lang_name, lang_code, words in word_lists if lang_name.casefold() != 'key']
+
+class CognateDetector:
+    '''Clusters the words of several languages into cognate sets.
+
+    Comparing every word with every other one doesn't scale, so the words are first hashed
+    into buckets: each word is turned into the set of its n-grams of rough segment classes,
+    and words whose MinHash signatures agree on a whole band land in the same bucket.
+    Only words of different languages that share a bucket are compared with the form similarity,
+    and the pairs that are similar enough are joined by average linkage,
+    never putting two words of the same language in one set.'''
+
+    def __init__(self, sp=None, threshold=0.85, ngram=2, num_hashes=32, bands=8,
+                 max_bucket=100, same_gloss=False, seed=0):
+        if sp is None:
+            sp = SegmentParser()
+        self.sp = sp
+        self.threshold = threshold
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = num_hashes // bands
+        self.num_hashes = self.bands * self.rows
+        # buckets of words that are all alike (mostly short ones) would give too many pairs
+        self.max_bucket = max_bucket
+        self.same_gloss = same_gloss
+        rng = random.Random(seed)
+        self.hashes = [(rng.randrange(1, PRIME), rng.randrange(PRIME)) for n in range(self.num_hashes)]
+        fields = sp.features['a']._fields
+        self.class_mask = sum(1 << n for n, feature in enumerate(fields) if feature not in VOLATILE_FEATURES)
+        self.shingle_ids = {}
+
+    def shingles(self, form):
+        '''Ids of the n-grams of segment classes in a form, with the edges of the word marked'''
+        classes = [-1] + [segment.bits & self.class_mask if segment.bits is not None else -2
+                            for segment in form] + [-1]
+        ngrams = {tuple(classes[n:n + self.ngram]) for n in range(max(len(classes) - self.ngram + 1, 1))}
+        return [self.shingle_ids.setdefault(ngram, len(self.shingle_ids)) for ngram in ngrams]
+
+    def signatures(self, shingle_lists):
+        '''The MinHash signature of every word, one row each'''
+        if np is not None:
+            lengths = np.array([len(shingles) for shingles in shingle_lists], dtype=np.int64)
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            flat = np.array([x for shingles in shingle_lists for x in shingles], dtype=np.int64)
+            signatures = np.empty((len(shingle_lists), self.num_hashes), dtype=np.int64)
+            for n, (a, b) in enumerate(self.hashes):
+                signatures[:, n] = np.minimum.reduceat((a * flat + b) % PRIME, starts)
+            return signatures
+        return [[min((a * x + b) % PRIME for x in shingles) for a, b in self.hashes]
+                    for shingles in shingle_lists]
+
+    def buckets(self, signatures):
+        '''Yields the words that share a band of their signatures, bucket by bucket'''
+        for band in range(self.bands):
+            columns = slice(band * self.rows, (band + 1) * self.rows)
+            found = defaultdict(list)
+            if np is not None:
+                for n, key in enumerate(map(bytes, signatures[:, columns])):
+                    found[key].append(n)
+            else:
+                for n, signature in enumerate(signatures):
+                    found[tuple(signature[columns])].append(n)
+            for words in found.values():
+                if 1 < len(words) <= self.max_bucket:
+                    yield words
+
+    def candidates(self, forms, signatures):
+        '''Pairs of words from different languages that share a bucket at least once'''
+        pairs = set()
+        for words in self.buckets(signatures):
+            for x, n1 in enumerate(words):
+                for n2 in words[x + 1:]:
+                    if forms[n1].lang_code == forms[n2].lang_code:
+                        continue
+                    if self.same_gloss and forms[n1].gloss != forms[n2].gloss:
+                        continue
+                    pairs.add((n1, n2))
+        return pairs
+
+    def score(self, form1, form2):
+        '''The similarity of two forms, the same as sim_ratio in the reconstructor'''
+        return self._score(self._prepare(form1), self._prepare(form2))
+
+    def _prepare(self, form):
+        '''What scoring needs to know about a form, worked out once per word'''
+        return (str(form), form_bits(form))
+
+    def _score(self, prepared1, prepared2):
+        string1, bits1 = prepared1
+        string2, bits2 = prepared2
+        if string1 == string2:
+            return 1.0
+        return edit_ratio(bits1, bits2, self.sp.num_features)
+
+    def cluster(self, forms, scores):
+        '''Average linkage over the scored pairs, where pairs that weren't scored count as 0.
+        Returns the clusters (of more than one word) as lists of word numbers.'''
+        # an average is never more than the best score in it, so words without
+        # a single pair over the threshold can't end up in any cluster
+        linked = set()
+        for (n1, n2), score in scores.items():
+            if score >= self.threshold:
+                linked.add(n1)
+                linked.add(n2)
+        members = {}
+        langs = {}
+        # the sum of the scores between the words of two clusters, for every two that have any
+        totals = defaultdict(dict)
+        for (n1, n2), score in scores.items():
+            if not score or n1 not in linked or n2 not in linked:
+                continue
+            for n in (n1, n2):
+                members[n] = [n]
+                langs[n] = {forms[n].lang_code}
+            totals[n1][n2] = score
+            totals[n2][n1] = score
+        heap = [(-score, n1, n2) for (n1, n2), score in scores.items() if score >= self.threshold]
+        heapq.heapify(heap)
+
+        next_id = len(forms)
+        while heap:
+            score, c1, c2 = heapq.heappop(heap)
+            # pairs with a cluster that has been joined already are thrown away when they come up,
+            # and so are clusters with a word of the same language
+            if c1 not in members or c2 not in members or langs[c1] & langs[c2]:
+                continue
+            new = next_id
+            next_id += 1
+            members[new] = members.pop(c1) + members.pop(c2)
+            langs[new] = langs.pop(c1) | langs.pop(c2)
+            neighbours = totals.pop(c1)
+            for other, total in totals.pop(c2).items():
+                neighbours[other] = neighbours.get(other, 0.0) + total
+            neighbours.pop(c1, None)
+            neighbours.pop(c2, None)
+            for other, total in neighbours.items():
+                totals[other].pop(c1, None)
+                totals[other].pop(c2, None)
+                totals[other][new] = total
+                average = total / (len(members[new]) * len(members[other]))
+                if average >= self.threshold:
+                    heapq.heappush(heap, (-average, other, new))
+            totals[new] = neighbours
+
+        return sorted((sorted(words) for words in members.values() if len(words) > 1),
+                      key=lambda words: words[0])
+
+    def detect(self, word_lists):
+        '''Finds the cognate sets in word lists as read by read_word_lists'''
+        forms = []
+        for lang_name, lang_code, words in word_lists:
+            for gloss, form in words:
+                forms.append(Form(self.sp.parse(form), lang_code=lang_code, gloss=gloss))
+        all_langs = [lang_code for lang_name, lang_code, words in word_lists]
+
+        signatures = self.signatures([self.shingles(form) for form in forms])
+        prepared = [self._prepare(form) for form in forms]
+        scores = {(n1, n2): self._score(prepared[n1], prepared[n2])
+                    for n1, n2 in self.candidates(forms, signatures)}
+
+        cognate_sets = []
+        for words in self.cluster(forms, scores):
+            cognate_set = CognateSet(set(forms[n] for n in words))
+            for lang_code in all_langs:
+                if lang_code not in cognate_set.langs:
+                    cognate_set.mark_missing(lang_code)
+            cognate_sets.append(cognate_set)
+        return cognate_sets
+
+def write_lexemes(cognate_sets, word_lists, filename):
+    '''Writes the cognate sets to a lexemes file that the reconstructor can read,
+    with the most common gloss of each set as its gloss'''
+    glosses = [Counter(form.gloss for form in cognate_set).most_common(1)[0][0]
+                for cognate_set in cognate_sets]
+    lexemes = []
+    for lang_name, lang_code, words in word_lists:
+        forms = []
+        for cognate_set in cognate_sets:
+            found = [form for form in cognate_set if form.lang_code == lang_code]
+            forms.append(str(found[0]) if found else '-')
+        lexemes.append({'lang_name': lang_name, 'lang_code': lang_code,
+                        'forms': forms, 'glosses': glosses})
+    with open(filename, 'w') as f:
+        json.dump(lexemes, f, ensure_ascii=False, indent='\t')
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='find cognate sets in glossed word lists')
+    argparser.add_argument('-f', '--wordlists', type=str, required=True, help='word lists (JSON or SQLite database)')
+    argparser.add_argument('-o', '--output', type=str, help='write the cognate sets to this lexemes file')
+    argparser.add_argument('--threshold', type=float, default=0.85, help='how similar (0 to 1) words have to be on average to be cognates')
+    argparser.add_argument('--same-gloss', action='store_true', help='only words with the same gloss can be cognates')
+    argparser.add_argument('--hashes', type=int, default=32, help='length of the word signatures')
+    argparser.add_argument('--bands', type=int, default=8, help='number of bands the signatures are split into')
+    args = argparser.parse_args()
+
+    word_lists = read_word_lists(args.wordlists)
+    detector = CognateDetector(threshold=args.threshold, num_hashes=args.hashes,
+                               bands=args.bands, same_gloss=args.same_gloss)
+    cognate_sets = detector.detect(word_lists)
+    if args.output:
+        write_lexemes(cognate_sets, word_lists, args.output)
+        print('Wrote {} cognate sets to {}'.format(len(cognate_sets), args.output))
+    else:
+        for cognate_set in cognate_sets:
+            print(', '.join('{}: {}'.format(form.lang_code, form)
+                            for form in sorted(cognate_set, key=lambda form: form.lang_code)))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# compiled binary corpora of tokenised forms
+# pylexemes
+
+import mmap, struct, sys, io, argparse
+from array import array
+from helpers import SegmentParser, FormParser, Form, CognateSet, Segment, CorpusFileError
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import numpy as np
+except ImportError:
+    from warnings import warn
+    warn('numpy not found. Corpus arrays will be exposed as memoryviews.')
+    np = None
+
+MAGIC = b'PLXC'
+FORMAT_VERSION = 1
+
+# magic, format version, inventory version,
+# number of languages, cognate sets, forms and segments, length of the metadata
+HEADER = struct.Struct('<4sH16sIIIII')
+
+# the segment id of a symbol that is not in the inventory (like '-')
+MISSING = 0xFFFF
+
+'''The file is laid out as follows, every array starting at a multiple of 8 bytes:
+    header
+    segments        uint16[n_segments]  segment ids of all forms, one after another
+    form_offsets    uint32[n_forms + 1] where each form starts in segments (missing forms are empty)
+    form_langs      uint16[n_forms]     language number of each form
+    set_offsets     uint32[n_sets + 1]  where each cognate set starts in the forms
+    lang_forms      uint32[n_forms]     form numbers ordered by language
+    lang_offsets    uint32[n_langs + 1] where each language starts in lang_forms
+    metadata        JSON: language codes, glosses, symbols not in the inventory
+'''
+ARRAYS = [('segments', 'H'), ('form_offsets', 'I'), ('form_langs', 'H'),
+          ('set_offsets', 'I'), ('lang_forms', 'I'), ('lang_offsets', 'I')]
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _array_lengths(n_langs, n_sets, n_forms, n_segments):
+    return {'segments': n_segments, 'form_offsets': n_forms + 1, 'form_langs': n_forms,
+            'set_offsets': n_sets + 1, 'lang_forms': n_forms, 'lang_offsets': n_langs + 1}
+
+def compile_corpus(cognate_sets, filename, sp=None, lang_codes=None, glosses=None):
+    '''Writes tokenised cognate sets to a binary corpus file'''
+    with open(filename, 'wb') as f:
+        f.write(corpus_bytes(cognate_sets, sp, lang_codes, glosses))
+
+def corpus_bytes(cognate_sets, sp=None, lang_codes=None, glosses=None):
+    '''Tokenises cognate sets into the binary corpus format'''
+    if sp is None:
+        sp = SegmentParser()
+    segment_ids = {symbol: n for n, symbol in enumerate(sp.symbols)}
+
+    # cognate sets are unordered, so we keep the forms in a fixed language order
+    langs = list(lang_codes) if lang_codes is not None else []
+    for cognate_set in cognate_sets:
+        for lang_code in [form.lang_code for form in cognate_set] + sorted(cognate_set.missing):
+            if lang_code not in langs:
+                langs.append(lang_code)
+    lang_numbers = {lang: n for n, lang in enumerate(langs)}
+
+    extra_symbols = []
+    arrays = {name: array(typecode) for name, typecode in ARRAYS}
+    arrays['form_offsets'].append(0)
+    arrays['set_offsets'].append(0)
+    by_lang = [[] for lang in langs]
+
+    for cognate_set in cognate_sets:
+        # missing forms are stored as forms with no segments
+        entries = [(form.lang_code, form) for form in cognate_set]
+        entries += [(lang_code, []) for lang_code in cognate_set.missing]
+        for lang_code, form in sorted(entries, key=lambda entry: lang_numbers[entry[0]]):
+            for segment in form:
+                if segment.symbol in segment_ids:
+                    arrays['segments'].append(segment_ids[segment.symbol])
+                elif segment.symbol == '-':
+                    arrays['segments'].append(MISSING)
+                else:
+                    # symbols we don't know about get ids after the inventory
+                    if segment.symbol not in extra_symbols:
+                        extra_symbols.append(segment.symbol)
+                    arrays['segments'].append(len(sp.symbols) + extra_symbols.index(segment.symbol))
+            by_lang[lang_numbers[lang_code]].append(len(arrays['form_langs']))
+            arrays['form_langs'].append(lang_numbers[lang_code])
+            arrays['form_offsets'].append(len(arrays['segments']))
+        arrays['set_offsets'].append(len(arrays['form_langs']))
+
+    arrays['lang_offsets'].append(0)
+    for lang_forms in by_lang:
+        arrays['lang_forms'].extend(lang_forms)
+        arrays['lang_offsets'].append(len(arrays['lang_forms']))
+
+    meta = json.dumps({'lang_codes': langs, 'glosses': glosses,
+                       'extra_symbols': extra_symbols}).encode('utf-8')
+
+    f = io.BytesIO()
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, sp.version, len(langs),
+                        len(arrays['set_offsets']) - 1, len(arrays['form_langs']),
+                        len(arrays['segments']), len(meta)))
+    for name, typecode in ARRAYS:
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+        if sys.byteorder == 'big':
+            arrays[name].byteswap()
+        f.write(arrays[name].tobytes())
+    f.write(b'\0' * (_align(f.tell()) - f.tell()))
+    f.write(meta)
+    return f.getvalue()
+
+class CorpusFile:
+    '''A memory-mapped binary corpus. The arrays are views of the mapping,
+    so nothing is read or copied until it's used, and several processes
+    mapping the same file share its pages. Any other buffer in the same format
+    (like a block of shared memory) can be given instead of a file.'''
+
+    def __init__(self, filename=None, sp=None, buffer=None):
+        if buffer is None:
+            with open(filename, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = buffer
+        self.sp = sp
+
+        (magic, format_version, inventory_version, self.n_langs, self.n_sets,
+            self.n_forms, self.n_segments, meta_len) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise CorpusFileError('Not a pylexemes corpus file')
+        if format_version != FORMAT_VERSION:
+            raise CorpusFileError('Unsupported corpus format version {}'.format(format_version))
+        if sp is not None and inventory_version != sp.version:
+            raise CorpusFileError('The corpus was compiled against a different segment inventory. Recompile it.')
+        self.inventory_version = inventory_version
+
+        lengths = _array_lengths(self.n_langs, self.n_sets, self.n_forms, self.n_segments)
+        offset = HEADER.size
+        for name, typecode in ARRAYS:
+            offset = _align(offset)
+            setattr(self, name, self._view(offset, typecode, lengths[name]))
+            offset += lengths[name] * array(typecode).itemsize
+        offset = _align(offset)
+        meta = json.loads(bytes(buffer[offset:offset + meta_len]).decode('utf-8'))
+        self.lang_codes = meta['lang_codes']
+        self.glosses = meta['glosses']
+        self.extra_symbols = meta['extra_symbols']
+
+    def _view(self, offset, typecode, length):
+        if np is not None:
+            return np.frombuffer(self.buffer, dtype='<u{}'.format(array(typecode).itemsize),
+                                 count=length, offset=offset)
+        # memoryviews use the native byte order, which is fine everywhere but big-endian machines
+        itemsize = array(typecode).itemsize
+        return memoryview(self.buffer)[offset:offset + length * itemsize].cast(typecode)
+
+    def __len__(self):
+        return self.n_sets
+
+    def __iter__(self):
+        return (self.cognate_set(n) for n in range(self.n_sets))
+
+    def close(self):
+        '''Lets go of the arrays and unmaps the file. The arrays are views of the mapping,
+        so it can't be closed while any of them (or a view of one) is still around.'''
+        for name, typecode in ARRAYS:
+            setattr(self, name, None)
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def form_segments(self, n):
+        '''Segment ids of form number n'''
+        return self.segments[self.form_offsets[n]:self.form_offsets[n + 1]]
+
+    def set_forms(self, n):
+        '''Numbers of the forms in cognate set number n'''
+        return range(self.set_offsets[n], self.set_offsets[n + 1])
+
+    def lang_form_numbers(self, lang_code):
+        '''Numbers of all the forms of a language'''
+        n = self.lang_codes.index(lang_code)
+        return self.lang_forms[self.lang_offsets[n]:self.lang_offsets[n + 1]]
+
+    def _segment(self, segment_id):
+        if segment_id == MISSING:
+            return Segment('-', None, None)
+        elif segment_id >= len(self.sp.symbols):
+            # segments with diacritics are put together again, anything else has no features
+            symbol = self.extra_symbols[segment_id - len(self.sp.symbols)]
+            return self.sp.get_segment(symbol) or Segment(symbol, None, None)
+        else:
+            return self.sp.get_segment(self.sp.symbols[segment_id])
+
+    def form(self, n, gloss=None):
+        '''Builds a Form object for form number n'''
+        if self.sp is None:
+            raise CorpusFileError('Need a SegmentParser to build forms')
+        segments = [self._segment(int(segment_id)) for segment_id in self.form_segments(n)]
+        return Form(segments, lang_code=self.lang_codes[self.form_langs[n]], gloss=gloss)
+
+    def cognate_set(self, n):
+        '''Builds a CognateSet object for cognate set number n'''
+        gloss = self.glosses[n] if self.glosses is not None else None
+        cognate_set = CognateSet()
+        for form_n in self.set_forms(n):
+            if self.form_offsets[form_n] == self.form_offsets[form_n + 1]:
+                cognate_set.mark_missing(self.lang_codes[self.form_langs[form_n]])
+            else:
+                cognate_set.add(self.form(form_n, gloss))
+        return cognate_set
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='compile a lexemes file into a binary corpus')
+    argparser.add_argument('-f', '--lexemesfile', type=str, required=True, help='lexemes file (JSON or SQLite database)')
+    argparser.add_argument('-o', '--output', type=str, help='output file (by default the lexemes file with a .plxc extension)')
+    args = argparser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = args.lexemesfile.rsplit('.', 1)[0] + '.plxc'
+    lp = FormParser(args.lexemesfile)
+    compile_corpus(lp.forms, output, lp.sp, glosses=lp.glosses)
+    print('Compiled {} cognate sets into {}'.format(len(lp.forms), output))
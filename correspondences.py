@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# sound correspondences between languages across a whole dataset
+# pylexemes
+
+import argparse
+from collections import Counter, defaultdict
+from helpers import SegmentParser, FormParser, CorrespondenceIndexError
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+class CorrespondenceIndex:
+    '''Counts how often each segment of one language stands in the same position
+    as each segment of another, over all the cognate sets it's given.
+    Sets can be added at any time, and every lookup is a dict access.'''
+
+    def __init__(self, sp=None):
+        if sp is None:
+            sp = SegmentParser()
+        self.sp = sp
+        # segments put together from diacritics aren't in the inventory,
+        # so they're given the next ids as they turn up
+        self.symbols = list(sp.symbols)
+        self.segment_ids = {symbol: n for n, symbol in enumerate(self.symbols)}
+        # for each pair of languages, the counts are keyed by both segment ids packed into one int
+        # so that only the correspondences that actually occur take up any room
+        self.pairs = defaultdict(Counter)
+        # how many times a segment of the first language was compared to anything in the second
+        self.totals = defaultdict(Counter)
+        self.num_sets = 0
+
+    def _add_symbol(self, symbol):
+        if symbol not in self.segment_ids:
+            self.segment_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+
+    def _key(self, lang1, lang2, symbol1, symbol2):
+        '''The pair of languages is always stored in the same order'''
+        id1 = self.segment_ids.get(symbol1)
+        id2 = self.segment_ids.get(symbol2)
+        if id1 is None or id2 is None:
+            return None
+        if lang1 > lang2:
+            return ((lang2, lang1), id2 << 16 | id1)
+        return ((lang1, lang2), id1 << 16 | id2)
+
+    def add(self, cognate_set):
+        '''Counts the correspondences in one cognate set'''
+        positions = cognate_set.average_len
+        forms = [form for form in cognate_set if form.lang_code is not None]
+        for n in range(positions):
+            # segments that couldn't be made out have no features, and are left out
+            aligned = [(form.lang_code, form[n].symbol) for form in forms
+                            if n < len(form) and form[n].features is not None]
+            for lang, symbol in aligned:
+                self._add_symbol(symbol)
+            for x, (lang1, symbol1) in enumerate(aligned):
+                for lang2, symbol2 in aligned[x + 1:]:
+                    if lang1 == lang2:
+                        continue
+                    pair, key = self._key(lang1, lang2, symbol1, symbol2)
+                    self.pairs[pair][key] += 1
+                    self.totals[(lang1, lang2)][symbol1] += 1
+                    self.totals[(lang2, lang1)][symbol2] += 1
+        self.num_sets += 1
+
+    def add_all(self, cognate_sets):
+        for cognate_set in cognate_sets:
+            self.add(cognate_set)
+
+    def count(self, lang1, symbol1, lang2, symbol2):
+        '''How many times symbol1 in lang1 corresponds to symbol2 in lang2'''
+        found = self._key(lang1, lang2, symbol1, symbol2)
+        if found is None:
+            return 0
+        pair, key = found
+        if pair not in self.pairs:
+            return 0
+        return self.pairs[pair][key]
+
+    def ratio(self, lang1, symbol1, lang2, symbol2):
+        '''How often symbol1 in lang1 corresponds to symbol2 in lang2,
+        out of all the times it corresponds to anything there'''
+        total = self.totals.get((lang1, lang2), {}).get(symbol1, 0)
+        if total == 0:
+            return 0.0
+        return self.count(lang1, symbol1, lang2, symbol2) / total
+
+    def correspondences(self, lang1, lang2):
+        '''All the correspondences between two languages, most frequent first'''
+        found = []
+        for key, count in self.pairs.get(tuple(sorted((lang1, lang2))), {}).items():
+            symbol1 = self.symbols[key >> 16]
+            symbol2 = self.symbols[key & 0xFFFF]
+            if lang1 > lang2:
+                symbol1, symbol2 = symbol2, symbol1
+            found.append((symbol1, symbol2, count))
+        return sorted(found, key=lambda c: c[2], reverse=True)
+
+    def save(self, filename):
+        data = {'version': self.sp.version.hex(),
+                'num_sets': self.num_sets,
+                'composed': self.symbols[len(self.sp.symbols):],
+                'pairs': [[lang1, lang2, sorted(counts.items())]
+                            for (lang1, lang2), counts in self.pairs.items()],
+                'totals': [[lang1, lang2, counts]
+                            for (lang1, lang2), counts in self.totals.items()]}
+        with open(filename, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, filename, sp=None):
+        index = cls(sp)
+        with open(filename) as f:
+            data = json.load(f)
+        if data['version'] != index.sp.version.hex():
+            raise CorrespondenceIndexError('The index was built with a different segment inventory')
+        index.num_sets = data['num_sets']
+        for symbol in data.get('composed', []):
+            index._add_symbol(symbol)
+        for lang1, lang2, counts in data['pairs']:
+            index.pairs[(lang1, lang2)] = Counter(dict((key, count) for key, count in counts))
+        for lang1, lang2, counts in data['totals']:
+            index.totals[(lang1, lang2)] = Counter(counts)
+        return index
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='build an index of sound correspondences')
+    argparser.add_argument('-f', '--lexemesfile', type=str, required=True, help='lexemes file (JSON or SQLite database)')
+    argparser.add_argument('-o', '--output', type=str, help='save the index to this file')
+    argparser.add_argument('--pair', type=str, nargs=2, metavar=('LANG1', 'LANG2'), help='show the correspondences between two languages')
+    args = argparser.parse_args()
+
+    lp = FormParser(args.lexemesfile)
+    index = CorrespondenceIndex(lp.sp)
+    index.add_all(lp.forms)
+    if args.output:
+        index.save(args.output)
+    if args.pair:
+        for symbol1, symbol2, count in index.correspondences(*args.pair):
+            print('{} : {}  {}'.format(symbol1, symbol2, count))
+    else:
+        print('{} cognate sets, {} language pairs'.format(index.num_sets, len(index.pairs)))
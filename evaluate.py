@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# scores reconstructions of many datasets against their keys
+# pylexemes
+
+import argparse, contextlib, csv, sys
+import collections as c
+import itertools as i
+from multiprocessing import Pool
+from helpers import FormParser
+from reconstructor import Reconstructor
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# every worker process reconstructs with an engine of its own
+engine = None
+
+def init_worker():
+    global engine
+    engine = Reconstructor()
+
+def evaluate_dataset(task):
+    '''Reconstructs one dataset and scores it against its key. A dataset that can't be
+    read or reconstructed comes back with the error instead, so it doesn't stop the rest.'''
+    filename, threshold = task
+    try:
+        # anything printed on the way would end up in the middle of the report
+        with contextlib.redirect_stdout(sys.stderr):
+            return score_dataset(filename, threshold)
+    except Exception as e:
+        return {'dataset': filename, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+def score_dataset(filename, threshold):
+    lp = FormParser(filename, store_langs=False)
+    if lp.true_recs is None:
+        return None
+    recs = engine.reconstruct_many(lp.forms, parallel=False)
+    # sets that the key has no form for can't be scored
+    scored = [(rec, true_rec) for rec, true_rec in zip(recs, lp.true_recs) if true_rec != '-']
+    ratios = [engine.sim_ratio(rec, true_rec)[2] for rec, true_rec in scored]
+
+    # how often each position of the key was reconstructed right
+    positions = []
+    for rec, true_rec in scored:
+        rec_f = engine.to_form(rec)
+        true_f = engine.to_form(true_rec)
+        for n, (s1, s2) in enumerate(i.zip_longest(rec_f, true_f)):
+            if s2 is None:
+                break
+            if n == len(positions):
+                positions.append([0, 0])
+            positions[n][1] += 1
+            if s1 is not None and s1.symbol == s2.symbol:
+                positions[n][0] += 1
+
+    # the averages are weighted by the forms that went into them
+    lang_counts = c.Counter()
+    lang_ratios = engine.calculate_reconstruction_ratios(recs, lp.forms, lang_counts)
+    return {'dataset': filename,
+            'sets': len(ratios),
+            'unscored': len(recs) - len(ratios),
+            'passed': sum(1 for ratio in ratios if ratio >= threshold),
+            'avg_ratio': sum(ratios) / len(ratios) if ratios else 0.0,
+            'langs': {lang: [lang_ratios[lang], lang_counts[lang]] for lang in lang_ratios},
+            'positions': positions}
+
+def evaluate(filenames, threshold=0.85, processes=None):
+    '''Scores all the datasets in parallel and puts the results together'''
+    with Pool(processes=processes, initializer=init_worker) as pool:
+        results = pool.map(evaluate_dataset, [(filename, threshold) for filename in filenames])
+    skipped = [filename for filename, result in zip(filenames, results) if result is None]
+    failed = [result for result in results if result is not None and 'error' in result]
+    results = [result for result in results if result is not None and 'error' not in result]
+
+    langs = {}
+    positions = []
+    for result in results:
+        for lang, (ratio, count) in result['langs'].items():
+            total, total_count = langs.get(lang, (0.0, 0))
+            langs[lang] = (total + ratio * count, total_count + count)
+        for n, (right, total) in enumerate(result['positions']):
+            if n == len(positions):
+                positions.append([0, 0])
+            positions[n][0] += right
+            positions[n][1] += total
+
+    sets = sum(result['sets'] for result in results)
+    passed = sum(result['passed'] for result in results)
+    return {'threshold': threshold,
+            'sets': sets,
+            'unscored': sum(result['unscored'] for result in results),
+            'passed': passed,
+            'accuracy': passed / sets if sets else 0.0,
+            'avg_ratio': (sum(result['avg_ratio'] * result['sets'] for result in results) / sets
+                            if sets else 0.0),
+            'datasets': [{'dataset': result['dataset'], 'sets': result['sets'],
+                          'unscored': result['unscored'],
+                          'passed': result['passed'],
+                          'accuracy': result['passed'] / result['sets'] if result['sets'] else 0.0,
+                          'avg_ratio': result['avg_ratio']} for result in results],
+            'langs': {lang: total / count for lang, (total, count) in langs.items() if count},
+            'positions': [right / total for right, total in positions],
+            'skipped': skipped,
+            'failed': failed}
+
+def write_csv(report, f):
+    '''One row for each dataset, language and position, and one for the total'''
+    writer = csv.writer(f)
+    writer.writerow(['kind', 'name', 'sets', 'passed', 'accuracy', 'avg_ratio', 'error'])
+    for d in report['datasets']:
+        writer.writerow(['dataset', d['dataset'], d['sets'], d['passed'],
+                         round(d['accuracy'], 4), round(d['avg_ratio'], 4)])
+    for lang, ratio in sorted(report['langs'].items()):
+        writer.writerow(['lang', lang, '', '', '', round(ratio, 4)])
+    for n, accuracy in enumerate(report['positions']):
+        writer.writerow(['position', n, '', '', round(accuracy, 4), ''])
+    for d in report['failed']:
+        writer.writerow(['failed', d['dataset'], '', '', '', '', d['error']])
+    writer.writerow(['total', '', report['sets'], report['passed'],
+                     round(report['accuracy'], 4), round(report['avg_ratio'], 4)])
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='score reconstructions of datasets with a key against it')
+    argparser.add_argument('files', type=str, nargs='+', help='lexemes files with a key entry')
+    argparser.add_argument('--threshold', type=float, default=0.85, help='similarity ratio (0 to 1) for a reconstruction to pass')
+    argparser.add_argument('-p', '--processes', type=int, help='number of worker processes (by default one per CPU)')
+    argparser.add_argument('--format', choices=['json', 'csv'], default='json', help='format of the report')
+    argparser.add_argument('-o', '--output', type=str, help='write the report to a file instead of printing it')
+    args = argparser.parse_args()
+
+    report = evaluate(args.files, args.threshold, args.processes)
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    if args.format == 'csv':
+        write_csv(report, out)
+    else:
+        json.dump(report, out, separators=(',', ':'))
+        out.write('\n')
+    if args.output:
+        out.close()
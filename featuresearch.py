@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# searching the corpus for forms that match patterns of feature classes
+# pylexemes
+
+import argparse, time
+from collections import namedtuple
+from helpers import FormParser, PatternError
+from corpusfile import CorpusFile, corpus_bytes, MAGIC, MISSING
+try:
+    import numpy as np
+except ImportError:
+    from warnings import warn
+    warn('numpy not found. Every form will be searched one by one, which is much slower.')
+    np = None
+
+'''Patterns are written much like the environments of phonological rules:
+    [+nasal]            any nasal segment
+    [-voice,+cont]      any segment that is voiceless and continuant (- and 0 mean the same)
+    a                   the segment a (symbols can be strung together, like ts or ana)
+    .                   any segment
+    (...)               a group
+    x|y                 either x or y
+    x? x* x+            x or nothing, any number of x, at least one x
+    #                   the start of the form at the beginning of a pattern, and its end at the end
+'''
+
+# one match of a pattern: the number of the cognate set, the language and the form,
+# and where the matching segments start and end in the form
+Match = namedtuple('Match', ['cognate_set', 'lang_code', 'form', 'start', 'end'])
+
+SPECIAL = '[](),|?*+.#'
+
+# no state to go to
+DEAD = -1
+
+class _Parser:
+    '''Parses a pattern into a tree of ('class', bits), ('seq', [...]), ('alt', [...]),
+    ('star', x), ('plus', x) and ('opt', x), where bits has a bit set for every segment id in the class'''
+
+    def __init__(self, text, search):
+        self.text = text
+        self.search = search
+        self.pos = 0
+
+    def error(self, message):
+        return PatternError('{} at position {} of {}'.format(message, self.pos, self.text))
+
+    def peek(self):
+        while self.pos < len(self.text) and self.text[self.pos].isspace():
+            self.pos += 1
+        return self.text[self.pos] if self.pos < len(self.text) else None
+
+    def parse(self):
+        node = self.alternatives()
+        if self.peek() is not None:
+            raise self.error("Unexpected '{}'".format(self.peek()))
+        return node
+
+    def alternatives(self):
+        options = [self.sequence()]
+        while self.peek() == '|':
+            self.pos += 1
+            options.append(self.sequence())
+        return options[0] if len(options) == 1 else ('alt', options)
+
+    def sequence(self):
+        items = []
+        while self.peek() not in (None, '|', ')'):
+            items.extend(self.item())
+        return ('seq', items)
+
+    def item(self):
+        atoms = self.atoms()
+        if self.peek() in ('*', '+', '?'):
+            operator = {'*': 'star', '+': 'plus', '?': 'opt'}[self.peek()]
+            self.pos += 1
+            # a quantifier after a string of symbols only goes with the last one
+            atoms[-1] = (operator, atoms[-1])
+        return atoms
+
+    def atoms(self):
+        char = self.peek()
+        if char == '[':
+            self.pos += 1
+            end = self.text.find(']', self.pos)
+            if end == -1:
+                raise self.error("Missing ']'")
+            specs = self.text[self.pos:end]
+            self.pos = end + 1
+            return [('class', self.search.feature_class(specs))]
+        elif char == '(':
+            self.pos += 1
+            node = self.alternatives()
+            if self.peek() != ')':
+                raise self.error("Missing ')'")
+            self.pos += 1
+            return [node]
+        elif char == '.':
+            self.pos += 1
+            return [('class', self.search.any_ids)]
+        elif char == '#':
+            raise self.error("'#' can only be at the start or the end")
+        elif char in SPECIAL:
+            raise self.error("Unexpected '{}'".format(char))
+        # a string of symbols, one class for each segment
+        start = self.pos
+        while (self.pos < len(self.text) and self.text[self.pos] not in SPECIAL
+                and not self.text[self.pos].isspace()):
+            self.pos += 1
+        symbols = self.text[start:self.pos]
+        return [('class', self.search.symbol_class(segment.symbol))
+                    for segment in self.search.sp.parse(symbols)]
+
+class _NFA:
+    '''A Thompson automaton: each state has empty moves and moves on a class of segments'''
+
+    def __init__(self):
+        self.empty = []
+        self.moves = []
+        self.classes = []
+        self.class_numbers = {}
+
+    def state(self):
+        self.empty.append([])
+        self.moves.append([])
+        return len(self.empty) - 1
+
+    def build(self, node):
+        '''Returns the start and end states of the part of the automaton for node'''
+        kind = node[0]
+        if kind == 'class':
+            start, end = self.state(), self.state()
+            number = self.class_numbers.setdefault(node[1], len(self.classes))
+            if number == len(self.classes):
+                self.classes.append(node[1])
+            self.moves[start].append((number, end))
+        elif kind == 'seq':
+            start = end = self.state()
+            for item in node[1]:
+                item_start, item_end = self.build(item)
+                self.empty[end].append(item_start)
+                end = item_end
+        elif kind == 'alt':
+            start, end = self.state(), self.state()
+            for option in node[1]:
+                option_start, option_end = self.build(option)
+                self.empty[start].append(option_start)
+                self.empty[option_end].append(end)
+        else:
+            inner_start, inner_end = self.build(node[1])
+            start, end = self.state(), self.state()
+            self.empty[start].append(inner_start)
+            self.empty[inner_end].append(end)
+            if kind in ('star', 'opt'):
+                self.empty[start].append(end)
+            if kind in ('star', 'plus'):
+                self.empty[inner_end].append(inner_start)
+        return (start, end)
+
+    def closure(self, states):
+        found = set(states)
+        stack = list(states)
+        while stack:
+            for other in self.empty[stack.pop()]:
+                if other not in found:
+                    found.add(other)
+                    stack.append(other)
+        return frozenset(found)
+
+class Pattern:
+    '''A compiled pattern: a deterministic automaton whose input is the segment ids of a form.
+    Segment ids that no class of the pattern tells apart share a column of the transition table,
+    so the table stays small however big the inventory is.'''
+
+    def __init__(self, text, tree, n_ids, anchored_start=False, anchored_end=False):
+        self.text = text
+        self.anchored_start = anchored_start
+        self.anchored_end = anchored_end
+
+        nfa = _NFA()
+        nfa_start, nfa_end = nfa.build(tree)
+
+        # ids that are in the same classes get the same column, and ids in none get column 0
+        signatures = {(0,) * len(nfa.classes): 0}
+        self.id_columns = []
+        for segment_id in range(n_ids):
+            signature = tuple(cls >> segment_id & 1 for cls in nfa.classes)
+            self.id_columns.append(signatures.setdefault(signature, len(signatures)))
+        columns = sorted(signatures, key=signatures.get)
+
+        # subset construction, state 0 is the start
+        numbers = {}
+        self.transitions = []
+        self.accepting = []
+        start = nfa.closure([nfa_start])
+        numbers[start] = 0
+        queue = [start]
+        while queue:
+            states = queue.pop()
+            number = numbers[states]
+            while len(self.transitions) <= number:
+                self.transitions.append(None)
+                self.accepting.append(False)
+            self.accepting[number] = nfa_end in states
+            row = []
+            for signature in columns:
+                following = [other for state in states for cls, other in nfa.moves[state]
+                                if signature[cls]]
+                if not following:
+                    row.append(DEAD)
+                    continue
+                following = nfa.closure(following)
+                if following not in numbers:
+                    numbers[following] = len(numbers)
+                    queue.append(following)
+                row.append(numbers[following])
+            self.transitions[number] = row
+
+    def __repr__(self):
+        return 'Pattern({})'.format(self.text)
+
+    def match_columns(self, columns, start):
+        '''Where the longest match starting at start ends, or None if there isn't one.
+        Empty matches don't count.'''
+        state = 0
+        end = None
+        transitions = self.transitions
+        accepting = self.accepting
+        for position in range(start, len(columns)):
+            state = transitions[state][columns[position]]
+            if state == DEAD:
+                # a match anchored at the end has to get there
+                return None if self.anchored_end else end
+            if accepting[state]:
+                end = position + 1
+        if self.anchored_end and end != len(columns):
+            return None
+        return end
+
+    def finditer(self, columns):
+        '''Yields (start, end) of every match that doesn't overlap an earlier one'''
+        start = 0
+        last_start = 0 if self.anchored_start else len(columns) - 1
+        first_row = self.transitions[0]
+        while start <= last_start and start < len(columns):
+            if first_row[columns[start]] != DEAD:
+                end = self.match_columns(columns, start)
+                if end is not None:
+                    yield (start, end)
+                    start = end
+                    continue
+            start += 1
+
+class FeatureSearch:
+    '''Searches a corpus (a CorpusFile with a SegmentParser) for patterns of segments.
+    The segment ids that have each feature are worked out once, as bitsets,
+    so a class like [+nasal,-voice] is just a couple of ANDs. Compiled patterns are kept
+    for when they come up again.'''
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.sp = corpus.sp
+        self.n_ids = len(self.sp.symbols) + len(corpus.extra_symbols)
+        segments = [corpus._segment(segment_id) for segment_id in range(self.n_ids)]
+        self.symbols = [segment.symbol for segment in segments]
+        self.symbol_ids = {}
+        for segment_id, symbol in enumerate(self.symbols):
+            self.symbol_ids.setdefault(symbol, segment_id)
+
+        fields = self.sp.features['a']._fields
+        self.feature_names = {name.casefold(): name for name in fields}
+        # the ids of the segments that have each feature, and of all the segments that have features at all
+        self.feature_ids = {name: 0 for name in fields}
+        self.featured_ids = 0
+        for segment_id, segment in enumerate(segments):
+            if segment.bits is None:
+                continue
+            self.featured_ids |= 1 << segment_id
+            for n, name in enumerate(fields):
+                if segment.bits >> n & 1:
+                    self.feature_ids[name] |= 1 << segment_id
+        self.any_ids = (1 << self.n_ids) - 1
+        self._patterns = {}
+        self._positions = None
+        # forms as strings, for the ones that have matched
+        self._forms = {}
+
+    def feature_class(self, specs):
+        '''The ids of the segments with all the features in a spec like +nasal,-voice'''
+        bits = self.featured_ids
+        for spec in specs.split(','):
+            spec = spec.strip()
+            if len(spec) < 2 or spec[0] not in '+-0':
+                raise PatternError("Features have to be like +nasal or -voice, not '{}'".format(spec))
+            name = self.feature_names.get(spec[1:].strip().casefold())
+            if name is None:
+                raise PatternError('Unknown feature: {}'.format(spec[1:].strip()))
+            if spec[0] == '+':
+                bits &= self.feature_ids[name]
+            else:
+                bits &= ~self.feature_ids[name]
+        return bits
+
+    def symbol_class(self, symbol):
+        segment_id = self.symbol_ids.get(symbol)
+        # a symbol that isn't in the corpus can't match anything
+        return 0 if segment_id is None else 1 << segment_id
+
+    def compile(self, text):
+        if text in self._patterns:
+            return self._patterns[text]
+        body = text.strip()
+        anchored_start = body.startswith('#')
+        anchored_end = body.endswith('#') and len(body) > 1
+        body = body[1 if anchored_start else 0:len(body) - 1 if anchored_end else len(body)]
+        tree = _Parser(body, self).parse()
+        pattern = Pattern(text, tree, self.n_ids, anchored_start, anchored_end)
+        self._patterns[text] = pattern
+        return pattern
+
+    def _index(self):
+        '''The form of every position in the corpus, where that form ends,
+        and the cognate set of every form, worked out the first time they're needed'''
+        if self._positions is None:
+            corpus = self.corpus
+            form_lengths = np.diff(np.asarray(corpus.form_offsets, dtype=np.int64))
+            position_forms = np.repeat(np.arange(corpus.n_forms), form_lengths)
+            position_ends = np.asarray(corpus.form_offsets, dtype=np.int64)[1:][position_forms]
+            form_sets = np.repeat(np.arange(corpus.n_sets),
+                                  np.diff(np.asarray(corpus.set_offsets, dtype=np.int64)))
+            self._positions = (position_forms, position_ends, form_sets)
+        return self._positions
+
+    def form_string(self, form_n):
+        form = self._forms.get(form_n)
+        if form is None:
+            form = ''.join(self.symbols[segment_id] if segment_id < self.n_ids else '-'
+                            for segment_id in self.corpus.form_segments(form_n))
+            self._forms[form_n] = form
+        return form
+
+    def search(self, text, lang_codes=None):
+        '''Returns a Match for every place in every form that matches the pattern,
+        leftmost first and as long as they go, without overlaps'''
+        pattern = self.compile(text)
+        corpus = self.corpus
+        langs = None
+        if lang_codes is not None:
+            langs = [corpus.lang_codes.index(lang) for lang in lang_codes if lang in corpus.lang_codes]
+        if np is None:
+            return self._search_forms(pattern, langs)
+
+        position_forms, position_ends, form_sets = self._index()
+        dead = len(pattern.transitions)
+        table = np.array([[dead if state == DEAD else state for state in row]
+                            for row in pattern.transitions] + [[dead] * len(pattern.transitions[0])],
+                         dtype=np.int32)
+        accepting = np.array(pattern.accepting + [False])
+        id_columns = np.zeros(MISSING + 1, dtype=np.int32)
+        id_columns[:self.n_ids] = pattern.id_columns
+        columns = id_columns[corpus.segments]
+
+        # every place a match can start, all run through the automaton together, a segment at a time
+        starts = np.flatnonzero(table[0][columns] != dead)
+        if pattern.anchored_start:
+            starts = starts[np.asarray(corpus.form_offsets)[position_forms[starts]] == starts]
+        if langs is not None:
+            starts = starts[np.isin(np.asarray(corpus.form_langs)[position_forms[starts]], langs)]
+        ends = np.full(len(starts), -1, dtype=np.int64)
+        active = np.arange(len(starts))
+        positions = starts.copy()
+        limits = position_ends[starts]
+        states = np.zeros(len(starts), dtype=np.int32)
+        while active.size:
+            inside = positions < limits
+            active, positions, limits, states = active[inside], positions[inside], limits[inside], states[inside]
+            states = table[states, columns[positions]]
+            alive = states != dead
+            active, positions, limits, states = active[alive], positions[alive], limits[alive], states[alive]
+            found = accepting[states]
+            if pattern.anchored_end:
+                found &= positions + 1 == limits
+            ends[active[found]] = positions[found] + 1
+            positions = positions + 1
+
+        # the longest match at each start, skipping the ones inside an earlier match
+        matched = ends >= 0
+        match_starts = starts[matched]
+        match_ends = ends[matched]
+        match_forms = position_forms[match_starts]
+        offsets = np.asarray(corpus.form_offsets, dtype=np.int64)[match_forms]
+        matches = []
+        last_form = -1
+        last_end = 0
+        for form_n, start, end, offset in zip(match_forms.tolist(), match_starts.tolist(),
+                                              match_ends.tolist(), offsets.tolist()):
+            if form_n == last_form and start < last_end:
+                continue
+            last_form = form_n
+            last_end = end
+            matches.append(Match(int(form_sets[form_n]), corpus.lang_codes[corpus.form_langs[form_n]],
+                                 self.form_string(form_n), start - offset, end - offset))
+        return matches
+
+    def _search_forms(self, pattern, langs=None):
+        '''The same as search, a form at a time'''
+        corpus = self.corpus
+        matches = []
+        set_n = 0
+        for form_n in range(corpus.n_forms):
+            while corpus.set_offsets[set_n + 1] <= form_n:
+                set_n += 1
+            if langs is not None and corpus.form_langs[form_n] not in langs:
+                continue
+            columns = [pattern.id_columns[segment_id] if segment_id < self.n_ids else 0
+                            for segment_id in corpus.form_segments(form_n)]
+            for start, end in pattern.finditer(columns):
+                matches.append(Match(set_n, corpus.lang_codes[corpus.form_langs[form_n]],
+                                     self.form_string(form_n), start, end))
+        return matches
+
+def open_corpus(filename):
+    '''Opens a compiled corpus, or compiles a lexemes file (JSON or SQLite database) in memory.
+    The corpus should be closed when it's done with (it can be used in a with statement).'''
+    with open(filename, 'rb') as f:
+        compiled = f.read(len(MAGIC)) == MAGIC
+    if compiled:
+        return CorpusFile(filename, FormParser.sp)
+    lp = FormParser(filename, store_langs=False)
+    return CorpusFile(sp=lp.sp, buffer=corpus_bytes(lp.forms, lp.sp, glosses=lp.glosses))
+
+def print_matches(search, pattern, lang_codes=None, count=False):
+    start = time.time()
+    try:
+        matches = search.search(pattern, lang_codes)
+    except PatternError as e:
+        print(e)
+        return
+    if not count:
+        for match in matches:
+            segments = [segment.symbol for segment in search.sp.parse(match.form)]
+            shown = (''.join(segments[:match.start]) + '[' + ''.join(segments[match.start:match.end])
+                        + ']' + ''.join(segments[match.end:]))
+            print('{}\t{}\t{}\t{}'.format(match.cognate_set + 1, match.lang_code, shown, match.start))
+    print('{} matches in {} forms ({:.3f} s)'.format(
+            len(matches), len({(match.cognate_set, match.lang_code) for match in matches}),
+            time.time() - start))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='find the forms that match patterns of feature classes, like [+nasal][+syl][-voice,+cont]')
+    argparser.add_argument('-f', '--corpus', type=str, required=True, help='compiled corpus, or a lexemes file (JSON or SQLite database)')
+    argparser.add_argument('patterns', type=str, nargs='*', help='patterns to search for (without any, patterns are asked for one by one)')
+    argparser.add_argument('--langs', type=str, nargs='+', help='only search the forms of these languages')
+    argparser.add_argument('-c', '--count', action='store_true', help='only show the number of matches')
+    args = argparser.parse_args()
+
+    with open_corpus(args.corpus) as corpus:
+        search = FeatureSearch(corpus)
+        if args.patterns:
+            for pattern in args.patterns:
+                print_matches(search, pattern, args.langs, args.count)
+        else:
+            print("Enter a pattern, or 'quit' to stop.")
+            while True:
+                try:
+                    pattern = input('> ')
+                except EOFError:
+                    break
+                if pattern.strip() == 'quit':
+                    break
+                if pattern.strip():
+                    print_matches(search, pattern, args.langs, args.count)
+        del search
@@ -2,15 +2,20 @@
 # (c) Anton Osten
 # http://ostensible.me
 
-import re
+import hashlib, sys, time, os, unicodedata
 from collections import namedtuple
 from difflib import SequenceMatcher
+from lexemestore import LexemeStore, is_db_file
 try:
     import simplejson as json
 except ImportError:
     from warnings import warn
     warn('simplejson not found. Using site-provided json, parsing may be slower.')
     import json
+
+# the inventory and the other data files are next to this file, wherever it's run from
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+LANGS_FILE = os.path.join(DATA_DIR, 'langs.json')
     
 # custom errors
 
@@ -29,13 +34,128 @@ class FormParsingError(CustomError):
 
 class BadFormQueryError(CustomError):
     pass
+
+class CorpusFileError(CustomError):
+    pass
+
+class CorrespondenceIndexError(CustomError):
+    pass
+
+class CheckpointError(CustomError):
+    pass
+
+class PatternError(CustomError):
+    pass
     
+# functions
+
+def features_to_bits(features):
+    '''Packs a feature set into an int with a bit set for each true feature.
+    0 and False count as the same value, just like they compare equal.'''
+    bits = 0
+    for n, value in enumerate(features):
+        if value:
+            bits |= 1 << n
+    return bits
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+def form_bits(form):
+    '''The feature bitsets of the segments of a form, leaving out the ones without features'''
+    return [segment.bits for segment in form if segment.bits is not None]
+
+def edit_distance(bits1, bits2, num_features, max_distance=None, band=None):
+    '''The edit distance between two lists of segment bitsets, counted in features:
+    changing a segment into another costs the number of features they differ in,
+    and putting a segment in or leaving it out costs all of them.
+    Only the cells within band of the diagonal are worked out, so with a band
+    the distance can come out too high. With max_distance, anything further than
+    that many steps off the diagonal is left out too (it would cost more),
+    and it stops as soon as the distance is certain to be over max_distance,
+    returning how much it's certain to be instead (which is over max_distance, but
+    not the distance itself).'''
+    n1 = len(bits1)
+    n2 = len(bits2)
+    indel = num_features
+    if band is None:
+        band = max(n1, n2)
+    # the end can't be reached without going this far off the diagonal
+    band = max(band, abs(n1 - n2))
+    # what any path that leaves the band costs at least, if it's left out for costing too much
+    beyond = None
+    if max_distance is not None:
+        if abs(n1 - n2) * indel > max_distance:
+            return abs(n1 - n2) * indel
+        if max_distance // indel < band:
+            band = int(max_distance // indel)
+            beyond = (band + 1) * indel
+    # anything out of the band costs more than any path can
+    outside = (n1 + n2 + 1) * indel
+    previous = [j * indel if j <= band else outside for j in range(n2 + 1)]
+    for i in range(1, n1 + 1):
+        current = [outside] * (n2 + 1)
+        if i <= band:
+            current[0] = i * indel
+        segment = bits1[i - 1]
+        first = max(1, i - band)
+        last = min(n2, i + band)
+        for j in range(first, last + 1):
+            cost = previous[j - 1] + popcount(segment ^ bits2[j - 1])
+            if previous[j] + indel < cost:
+                cost = previous[j] + indel
+            if current[j - 1] + indel < cost:
+                cost = current[j - 1] + indel
+            current[j] = cost
+        if max_distance is not None:
+            # every path goes through this row, and from there it has to make up the difference in length
+            lowest = min(current[j] + abs((n1 - i) - (n2 - j)) * indel
+                            for j in range(first - 1, last + 1))
+            if lowest > max_distance:
+                return lowest if beyond is None else min(lowest, beyond)
+        previous = current
+    if beyond is not None and previous[n2] > max_distance:
+        return min(previous[n2], beyond)
+    return previous[n2]
+
+def edit_ratio(bits1, bits2, num_features, threshold=None, band=None):
+    '''The similarity (0 to 1) of two lists of segment bitsets from their edit distance,
+    as a share of the longer one. With a threshold, it stops as soon as the ratio
+    is certain to be under it, and gives a ratio that's too high (but still under the threshold).'''
+    longest = max(len(bits1), len(bits2))
+    if longest == 0 or not bits1 or not bits2:
+        return 0.0
+    scale = longest * num_features
+    max_distance = None
+    if threshold is not None:
+        # distances are whole numbers of features, and rounding mustn't make one that's
+        # only a bound look like it reaches the threshold
+        max_distance = int((1.0 - threshold) * scale + 1e-9)
+    return 1.0 - edit_distance(bits1, bits2, num_features, max_distance, band) / scale
+
+def edit_ratios(bits, others, num_features, threshold=None, band=None):
+    '''edit_ratio of one list of segment bitsets against many. The ones too different
+    in length to reach the threshold are given up on before any cell is worked out.'''
+    return [edit_ratio(bits, other, num_features, threshold, band) for other in others]
+
+def dataset_key(cognate_sets, sp):
+    '''A digest of the forms and the segment inventory, to tell whether
+    anything worked out from a dataset (and saved) is still good'''
+    digest = hashlib.md5(sp.version)
+    for cognate_set in cognate_sets:
+        for form in sorted(cognate_set, key=lambda form: (str(form.lang_code), str(form))):
+            digest.update('{}:{};'.format(form.lang_code, form).encode('utf-8'))
+        digest.update(b'|')
+    return digest.hexdigest()
+
 # classes
 
 class Segment:
     def __init__(self, symbol, name, features):
         self.symbol = symbol
         self.features = features
+        # features as a bitset for quick comparisons
+        self.bits = features_to_bits(features) if features is not None else None
     
     def __repr__(self):
         return 'Segment({})'.format(self.symbol)
@@ -44,14 +164,39 @@ class Segment:
         return self.symbol
 
 class SegmentParser:
-    '''Loads and parses segments from the segments.json file'''
-
-    def __init__(self, segments_f=None):
-
-        if segments_f == None:
-            segments = json.load(open('segments.json'))
+    '''Loads and parses segments from the segments.json file.
+    Diacritics from the diacritics.json file (if there is one) change some features
+    of the segment they follow, and segments with diacritics that aren't in
+    segments.json are put together from their base segment when they're first seen.'''
+
+    def __init__(self, segments_f=None, segments=None, diacritics_f=None, diacritics=None):
+
+        # the segment entries can also be given already loaded
+        if segments is not None:
+            pass
+        elif segments_f == None:
+            segments = json.load(open(os.path.join(DATA_DIR, 'segments.json')))
         else:
             segments = json.load(open(segments_f))
+        self.entries = segments
+
+        # and so can the diacritics
+        if diacritics is not None:
+            pass
+        elif diacritics_f is not None:
+            diacritics = json.load(open(diacritics_f))
+        elif os.path.exists(os.path.join(DATA_DIR, 'diacritics.json')):
+            diacritics = json.load(open(os.path.join(DATA_DIR, 'diacritics.json')))
+        else:
+            diacritics = []
+        self.diacritic_entries = diacritics
+
+        # identifies this particular inventory, so that anything compiled
+        # against it (like binary corpora) can tell when it's out of date
+        version = hashlib.md5(json.dumps(segments, sort_keys=True).encode('utf-8'))
+        if diacritics:
+            version.update(json.dumps(diacritics, sort_keys=True).encode('utf-8'))
+        self.version = version.digest()
 
         self.segments = set()
         self.symbols = []
@@ -69,6 +214,18 @@ class SegmentParser:
             segment_features = Features(**n['features'])
             self.features[symbol] = segment_features
             self.segments.add(Segment(symbol, segment_name, segment_features))
+        self._by_symbol = {segment.symbol: segment for segment in self.segments}
+
+        # diacritic symbol -> (name, the features it changes)
+        self.diacritics = {}
+        for n in diacritics:
+            unknown = set(n['features']) - set(Features._fields)
+            if unknown:
+                raise SegmentParsingError('Unknown features for diacritic {}: {}'.format(n['symbol'], ', '.join(sorted(unknown))))
+            self.diacritics[n['symbol']] = (n['name'], n['features'])
+        # segments put together from diacritics so far, and None for symbols that can't be
+        self._composed = {}
+        self._composed_segments = None
         
         # this is useful for mapping features back to symbols
         self.flipped_features = {self.features[segment]: segment for segment in self.features}
@@ -79,17 +236,32 @@ class SegmentParser:
         true_features = {}
 
         for s in self.features:
-            segment_features = vars(self.features[s])
+            segment_features = self.features[s]._asdict()
             segment_true_features = [f for f in segment_features if segment_features[f]]
             true_features[s] = segment_true_features
 
         self.true_features = true_features
+        # features as bitsets, for ranking segments quickly
+        self.feature_bits = {s: features_to_bits(self.features[s]) for s in self.features}
         self.duplicates = self.find_duplicates()
 
 
         # the number of all possible features for a segment
         self.num_features = len(self.features['a'])
 
+    @classmethod
+    def from_tables(cls, symbols, names, fields, bits, diacritics, version):
+        '''A parser for an inventory given as tables (like the ones shared with worker processes):
+        the symbols and names of the segments, the names of the features
+        and the feature bitset of each segment'''
+        segments = [{'symbol': symbol, 'name': name,
+                     'features': {field: bool(segment_bits >> n & 1) for n, field in enumerate(fields)}}
+                        for symbol, name, segment_bits in zip(symbols, names, bits)]
+        sp = cls(segments=segments, diacritics=diacritics)
+        # the features are only kept as true or false, so the version is the one of the original
+        sp.version = version
+        return sp
+
     # METHODS
 
     def find_duplicates(self):
@@ -122,35 +294,93 @@ class SegmentParser:
         return duplicate_groups
     
     def get_segment(self, symbol):
-        for segment in self.segments:
-            if segment.symbol == symbol:
-                return segment
+        '''Returns the segment for a symbol, or None if there is no such segment.
+        Segments with diacritics are put together the first time they're asked for.'''
+        segment = self._by_symbol.get(symbol)
+        if segment is None and self.diacritics:
+            if symbol not in self._composed:
+                self._composed[symbol] = self._compose(symbol)
+            segment = self._composed[symbol]
+        return segment
+
+    def _compose(self, symbol):
+        # precomposed letters like ã are a base and a combining diacritic
+        decomposed = unicodedata.normalize('NFD', symbol)
+        for end in range(len(decomposed), 0, -1):
+            base = unicodedata.normalize('NFC', decomposed[:end])
+            if base not in self._by_symbol:
+                continue
+            marks = decomposed[end:]
+            if not all(mark in self.diacritics for mark in marks):
+                return None
+            features = self._by_symbol[base].features
+            names = [self.names[base]]
+            for mark in marks:
+                name, changes = self.diacritics[mark]
+                features = features._replace(**changes)
+                names.insert(0, name)
+            return Segment(symbol, ' '.join(names), features)
+        return None
+
+    def composed_segments(self):
+        '''Every segment with one diacritic on it, unless there is a segment
+        with the same features already, for finding the segment nearest to some features.
+        They're only put together the first time they're needed.'''
+        if self._composed_segments is None:
+            seen = set(self.features.values())
+            composed = []
+            for symbol in self.symbols:
+                for mark in self.diacritics:
+                    segment = self.get_segment(symbol + mark)
+                    if segment is not None and segment.features not in seen:
+                        seen.add(segment.features)
+                        composed.append(segment)
+            self._composed_segments = composed
+        return self._composed_segments
     
     def parse(self, form):
         '''Tokenises a form into separate Segment objects,
-        detecting polysymbollic segments such as affricates'''
+        detecting polysymbollic segments such as affricates and diacritics'''
         segments = []
         i = 0
         while i < len(form):
-            cur_symbol = form[i]
-            next_symbol = form[(i + 1) % len(form)]
-            if cur_symbol + next_symbol in self.polysymbols:
-                segment = self.get_segment(cur_symbol + next_symbol)
-                i += 2
+            if form[i:i + 2] in self.polysymbols:
+                symbol = form[i:i + 2]
             else:
-                segment = self.get_segment(cur_symbol)
+                symbol = form[i]
+            i += len(symbol)
+            # diacritics belong to the segment before them
+            while i < len(form) and form[i] in self.diacritics:
+                symbol += form[i]
                 i += 1
 
+            segment = self.get_segment(symbol)
             if segment is None:
-                segment = Segment(cur_symbol, None, None)
+                segment = Segment(symbol, None, None)
 
             segments.append(segment)
         return segments
 
+def default_parser():
+    '''The SegmentParser for the default inventory. There's only ever one,
+    and it's only loaded the first time it's needed, not when this module is imported.'''
+    global _default_parser
+    if _default_parser is None:
+        _default_parser = SegmentParser()
+    return _default_parser
+
+_default_parser = None
+
+class DefaultParser:
+    '''A class attribute that is the default SegmentParser'''
+
+    def __get__(self, instance, owner):
+        return default_parser()
+
 class Form:
     '''A form is a list of segments'''
     
-    sp = SegmentParser()
+    sp = DefaultParser()
     
     def __init__(self, form, lang_code=None, gloss=None):
         self.str = ''
@@ -227,7 +457,10 @@ class Form:
         struct = []
         
         for segment in self.segments:
-            if segment.features.syl:
+            # segments we know nothing about have no place in the structure
+            if segment.features is None:
+                continue
+            elif segment.features.syl:
                 struct.append('V')
             elif segment.features.cons:
                 struct.append('C')
@@ -237,9 +470,13 @@ class Form:
         return struct
 
 class CognateSet:
-    '''A cognate set is a set-like collection of Form objects'''
+    '''A cognate set is a set-like collection of Form objects.
+    Languages without a form in the set are only kept track of in missing,
+    so they never turn up when going over the forms.'''
     
     def __init__(self, forms=None):
+        # language codes of the languages which have no form here
+        self.missing = set()
         if forms is None:
             self.forms = set()
         else:
@@ -333,6 +570,13 @@ class CognateSet:
         '''Flips the arrangement of the cognate set, so that each segment has its own row'''
         pass
     
+    def mark_missing(self, lang_code):
+        '''Records that a language has no form in the cognate set'''
+        self.missing.add(lang_code)
+    
+    def is_missing(self, lang_code):
+        return lang_code in self.missing
+    
     @property
     def langs(self):
         '''A set of ISO language codes present in the cognate set'''
@@ -341,32 +585,70 @@ class CognateSet:
     @property
     def average_len(self):
         '''Returns the rounded average length of all forms in the cognate set'''
-        lengths = [len(form) for form in self.forms]
-        return round(sum(lengths) / len(lengths))
+        if not self.forms:
+            return 0
+        return round(sum(len(form) for form in self.forms) / len(self.forms))
                         
                         
+class Progress:
+    '''Shows how many of a number of things are done, how fast it's going,
+    and how long the rest will take'''
+
+    def __init__(self, total, what='sets', out=sys.stderr):
+        self.total = total
+        self.what = what
+        self.out = out
+        self.done = 0
+        self.start = time.time()
+
+    def update(self, n=1):
+        self.done += n
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        self.out.write('\r{}/{} {}, {:.1f} {}/s, ETA {}:{:02d}:{:02d} '.format(
+                        self.done, self.total, self.what, rate, self.what,
+                        int(eta // 3600), int(eta % 3600 // 60), int(eta % 60)))
+        if self.done >= self.total:
+            self.out.write('\n')
+        self.out.flush()
+
 class FormParser:
     '''Parses forms to compute reconstructions from'''
     
-    sp = SegmentParser()
+    sp = DefaultParser()
 
-    def __init__(self, file):
+    def __init__(self, file, lang_codes=None, glosses=None, store_langs=True):
 
-        self.lexemes = json.load(open(file))
+        if is_db_file(file):
+            # with a lexeme database we can load only the languages and glosses we need
+            store = LexemeStore(file)
+            self.lexemes = store.lexemes(lang_codes, glosses)
+            store.close()
+        elif glosses is not None:
+            raise FormParsingError('Glosses can only be selected from a lexeme database')
+        else:
+            self.lexemes = json.load(open(file))
+            if lang_codes is not None:
+                self.lexemes = [n for n in self.lexemes if n.get('lang_code') in lang_codes
+                                    or n.get('lang_name', '').casefold() == 'key']
             
         self.lang_names = []
         self.lang_codes = []
         self.true_recs = None
+        self.glosses = None
         raw_forms = []
 
         for n in self.lexemes:
             try:
                 if n['lang_name'].casefold() == 'key':
-                    self.true_recs = re.findall('[\w-]+', n['forms'])
+                    self.true_recs = self._split_forms(n['forms'])
                 else:
                     self.lang_names.append(n['lang_name'])
                     self.lang_codes.append(n['lang_code'])
-                    lang_forms = re.findall('[\w-]+', n['forms'])
+                    lang_forms = self._split_forms(n['forms'])
+                    if 'glosses' in n:
+                        self.glosses = n['glosses']
                     # if the language code is unknown, let's make one up
                     # so that we can refer to it later on
                     raw_forms.append((lang_forms,
@@ -376,9 +658,20 @@ class FormParser:
                 self._somethingwrong(ke)
 
         self.forms = self._process_forms(raw_forms)
-        self._store_lang_info(self.lang_names, self.lang_codes)
+        if store_langs:
+            self._store_lang_info(self.lang_names, self.lang_codes)
+
+    @staticmethod
+    def _split_forms(forms):
+        # forms from a lexeme database are already split
+        if isinstance(forms, list):
+            return forms
+        # forms are separated by commas, and can have any characters in them,
+        # like diacritics (t', n̥) that aren't word characters
+        return [form.strip() for form in forms.split(',') if form.strip()]
     
-    def _get_lang_code(self, lang_code, lang_name):
+    @staticmethod
+    def _get_lang_code(lang_code, lang_name):
         '''Creates a language code for a language if it is not known'''
         # if we have a valid ISO language code
         if '?' not in lang_code:
@@ -399,16 +692,21 @@ class FormParser:
                 # n is the language number
                 # 0 or 1 is the index for either the forms in the language or its language code
                 # and num is the number of a particular form in that language
-                form_segments = self.sp.parse(raw_forms[n][0][num])
                 lang_code = raw_forms[n][1]
-                cset.add(Form(form_segments, lang_code=lang_code))
+                # a dash means the language has no form here
+                if raw_forms[n][0][num] == '-':
+                    cset.mark_missing(lang_code)
+                    continue
+                form_segments = self.sp.parse(raw_forms[n][0][num])
+                gloss = self.glosses[num] if self.glosses is not None else None
+                cset.add(Form(form_segments, lang_code=lang_code, gloss=gloss))
             processed_forms.append(cset)
         return processed_forms
 
     def _store_lang_info(self, lang_names, lang_codes):
         doc = "Stores language name and three letter ISO code in a langs.json file for future reference."
         try:
-            langs = json.load(open('langs.json'))
+            langs = json.load(open(LANGS_FILE))
         except:
             langs = json.loads('{}')
         for lang_name, lang_code in zip(lang_names, lang_codes):
@@ -422,8 +720,8 @@ class FormParser:
                     # if there is a language with that code, but it's named differently, we could change the current instance of it
                     # but I'm not sure if I want to do that
                     pass
-        if langs != json.load(open('langs.json')):
-            json.dump(langs, open('langs.json', 'w'))
+        if not os.path.exists(LANGS_FILE) or langs != json.load(open(LANGS_FILE)):
+            json.dump(langs, open(LANGS_FILE, 'w'))
 
     def _somethingwrong(self, e):
         doc = "Invoked when there is something wron in the lexemes.json file."
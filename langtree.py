@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# distances between languages and family trees built from them
+# pylexemes
+
+import argparse, heapq, os, sys
+from helpers import FormParser, form_bits, edit_ratio, dataset_key
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# goes up whenever the distances are worked out differently, so that cached ones are thrown out
+DISTANCES_VERSION = 2
+
+def distance_matrix(cognate_sets, sp, lang_codes=None):
+    '''Returns the languages and a matrix of their distances (1 minus the average
+    similarity ratio of their forms over all the cognate sets they both have a form in).
+    Forms are compared by edit_ratio, the same as in reconstruction.'''
+    if lang_codes is None:
+        lang_codes = sorted({form.lang_code for cognate_set in cognate_sets for form in cognate_set})
+    numbers = {lang: n for n, lang in enumerate(lang_codes)}
+    size = len(lang_codes)
+    totals = [[0.0] * size for n in range(size)]
+    counts = [[0] * size for n in range(size)]
+
+    for cognate_set in cognate_sets:
+        forms = [(numbers[form.lang_code], form_bits(form)) for form in cognate_set if form.lang_code in numbers]
+        for x, (n1, bits1) in enumerate(forms):
+            for n2, bits2 in forms[x + 1:]:
+                ratio = edit_ratio(bits1, bits2, sp.num_features)
+                totals[n1][n2] += ratio
+                totals[n2][n1] += ratio
+                counts[n1][n2] += 1
+                counts[n2][n1] += 1
+
+    matrix = [[0.0] * size for n in range(size)]
+    for n1 in range(size):
+        for n2 in range(size):
+            if n1 != n2:
+                # languages that never meet are as far apart as can be
+                matrix[n1][n2] = 1.0 - totals[n1][n2] / counts[n1][n2] if counts[n1][n2] else 1.0
+    return (lang_codes, matrix)
+
+def cached_distance_matrix(cognate_sets, sp, cache_file):
+    '''Same as distance_matrix, but only worked out again if the dataset has changed since it was cached'''
+    key = '{}:{}'.format(DISTANCES_VERSION, dataset_key(cognate_sets, sp))
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return (cached['langs'], cached['matrix'])
+    lang_codes, matrix = distance_matrix(cognate_sets, sp)
+    with open(cache_file, 'w') as f:
+        json.dump({'key': key, 'langs': lang_codes, 'matrix': matrix}, f, separators=(',', ':'))
+    return (lang_codes, matrix)
+
+class Node:
+    '''A node of a language tree. Leaves are single languages.'''
+
+    def __init__(self, langs, children=(), height=0.0):
+        self.langs = langs
+        self.children = list(children)
+        self.height = height
+
+    def __repr__(self):
+        return 'Node({})'.format(self.newick())
+
+    @property
+    def is_leaf(self):
+        return self.children == []
+
+    def postorder(self):
+        '''Yields the nodes from the leaves up, children before their parents,
+        which is the order to reconstruct in when going up the tree'''
+        for child in self.children:
+            yield from child.postorder()
+        yield self
+
+    def newick(self):
+        if self.is_leaf:
+            return self.langs[0]
+        return '({})'.format(','.join('{}:{:.4f}'.format(child.newick(), self.height - child.height)
+                                      for child in self.children))
+
+def upgma(lang_codes, matrix):
+    '''Builds a tree by joining the two closest clusters over and over.
+    The candidate pairs are kept in a heap, and pairs with a cluster that has already
+    been joined are thrown away when they come up, so it all takes O(n² log n).'''
+    clusters = {n: Node([lang]) for n, lang in enumerate(lang_codes)}
+    sizes = {n: 1 for n in clusters}
+    # distances between live clusters, each pair stored once with the smaller number first
+    distances = {}
+    heap = []
+    for n1 in range(len(lang_codes)):
+        for n2 in range(n1 + 1, len(lang_codes)):
+            distances[(n1, n2)] = matrix[n1][n2]
+            heap.append((matrix[n1][n2], n1, n2))
+    heapq.heapify(heap)
+
+    next_number = len(lang_codes)
+    while len(clusters) > 1:
+        distance, n1, n2 = heapq.heappop(heap)
+        if n1 not in clusters or n2 not in clusters:
+            continue
+        node = Node(clusters[n1].langs + clusters[n2].langs,
+                    (clusters.pop(n1), clusters.pop(n2)), distance / 2)
+        size1 = sizes.pop(n1)
+        size2 = sizes.pop(n2)
+        for other in clusters:
+            d1 = distances.pop((min(n1, other), max(n1, other)))
+            d2 = distances.pop((min(n2, other), max(n2, other)))
+            # the average distance from every language in one cluster to every one in the other
+            new_distance = (d1 * size1 + d2 * size2) / (size1 + size2)
+            distances[(other, next_number)] = new_distance
+            heapq.heappush(heap, (new_distance, other, next_number))
+        del distances[(n1, n2)]
+        clusters[next_number] = node
+        sizes[next_number] = size1 + size2
+        next_number += 1
+
+    return next(iter(clusters.values())) if clusters else None
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='build a language tree from the distances between languages')
+    argparser.add_argument('-f', '--lexemesfile', type=str, required=True, help='lexemes file (JSON or SQLite database)')
+    argparser.add_argument('-c', '--cache', type=str, help='cache the distance matrix in this file')
+    argparser.add_argument('-m', '--matrix', action='store_true', help='print the distance matrix too')
+    args = argparser.parse_args()
+
+    lp = FormParser(args.lexemesfile)
+    if args.cache:
+        lang_codes, matrix = cached_distance_matrix(lp.forms, lp.sp, args.cache)
+    else:
+        lang_codes, matrix = distance_matrix(lp.forms, lp.sp)
+    if args.matrix:
+        print('\t' + '\t'.join(lang_codes))
+        for lang, row in zip(lang_codes, matrix):
+            print(lang + '\t' + '\t'.join('{:.3f}'.format(d) for d in row))
+    tree = upgma(lang_codes, matrix)
+    if tree is None:
+        sys.exit('No languages in {} to build a tree from'.format(args.lexemesfile))
+    print(tree.newick() + ';')
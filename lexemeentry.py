@@ -1,55 +1,72 @@
 #!/usr/bin/env python3
 
 import json, argparse, os
+from lexemestore import LexemeStore, is_db_file
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('-f', '--filename', type=str, help='specify a filename for the lexemes database')
+argparser.add_argument('-d', '--database', action='store_true', help='store the lexemes in an SQLite database instead of a JSON file')
 args = argparser.parse_args()
 
 def main():
-	try: 
+	try:
 		langs = json.load(open('langs.json'))
 	except FileNotFoundError:
 		langs = {}
 
-	if args.filename:
-		if '.json' in args.filename:
-			lexemesfile = args.filename
-		else:
-			lexemesfile = args.filename + '.json'
+	if args.database or is_db_file(args.filename):
+		lexemesfile = args.filename if args.filename else 'lexemes'
+		if not is_db_file(lexemesfile):
+			lexemesfile += '.db'
+		store = LexemeStore(lexemesfile)
+		output = 'The following languages are already in the database:\n'
+		for lang in store.languages():
+			output += '{}\n'.format(list(lang))
+		print(output)
 	else:
-		lexemesfile = 'lexemes.json'
+		store = None
+		if args.filename:
+			if '.json' in args.filename:
+				lexemesfile = args.filename
+			else:
+				lexemesfile = args.filename + '.json'
+		else:
+			lexemesfile = 'lexemes.json'
 
-	try:
-		output = 'The following data is already in the file:\n'
-		lexemes = json.load(open(lexemesfile))
-		for l in lexemes:
-			output += '{}\n'.format(list(l.values()))
-		print(output)
-	except FileNotFoundError:
-		lexemes = []
+		try:
+			output = 'The following data is already in the file:\n'
+			lexemes = json.load(open(lexemesfile))
+			for l in lexemes:
+				output += '{}\n'.format(list(l.values()))
+			print(output)
+		except FileNotFoundError:
+			lexemes = []
 
-	print('Please enter a language name:')
-	lang_name = input('> ').title()
-	if lang_name == 'quit' or lang_name == '':
-		quit()
+	while True:
+		print('Please enter a language name:')
+		lang_name = input('> ').title()
+		if lang_name == 'quit' or lang_name == '':
+			quit()
 
-	try:
-		lang_code = langs[lang_name]
-	except KeyError:
-		print('Please enter its three letter ISO code:')
-		lang_code = input('> ').casefold()
+		try:
+			lang_code = langs[lang_name]
+		except KeyError:
+			print('Please enter its three letter ISO code:')
+			lang_code = input('> ').casefold()
 
-	print('Please enter forms separated by a comma (a, b, c, etc.) or dash (-) if there is no form:')
-	forms = input('> ').casefold()
+		print('Please enter forms separated by a comma (a, b, c, etc.) or dash (-) if there is no form:')
+		forms = input('> ').casefold()
 
-	entry = {"lang_name": lang_name, "lang_code": lang_code, "forms": forms}
-	add_entry(lexemesfile, entry, lexemes)
-	response = input("Would you like to add another entry? (y/n)\n> ").casefold()
-	if 'y' in response:
-		main()
-	else:
-		quit('Okay. See you later then!')
+		entry = {"lang_name": lang_name, "lang_code": lang_code, "forms": forms}
+		if store is not None:
+			# only this language's forms get written, in one transaction
+			store.add_entry(entry)
+		else:
+			add_entry(lexemesfile, entry, lexemes)
+		response = input("Would you like to add another entry? (y/n)\n> ").casefold()
+		if 'y' not in response:
+			break
+	quit('Okay. See you later then!')
 
 def add_entry(lexemesfile, entry, lexemes):
 	if entry['lang_name'] in [lexeme['lang_name'] for lexeme in lexemes]:
@@ -61,4 +78,4 @@ def add_entry(lexemesfile, entry, lexemes):
 	json.dump(lexemes, open(lexemesfile, 'w'))
 
 if __name__ == "__main__":
-	main()
\ No newline at end of file
+	main()
@@ -0,0 +1,159 @@
+# sqlite storage for lexemes
+# pylexemes
+
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS languages (
+    id INTEGER PRIMARY KEY,
+    lang_name TEXT NOT NULL UNIQUE,
+    lang_code TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS languages_lang_code ON languages (lang_code);
+
+CREATE TABLE IF NOT EXISTS glosses (
+    id INTEGER PRIMARY KEY,
+    gloss TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS forms (
+    lang_id INTEGER NOT NULL REFERENCES languages (id),
+    gloss_id INTEGER NOT NULL REFERENCES glosses (id),
+    form TEXT NOT NULL,
+    PRIMARY KEY (lang_id, gloss_id)
+);
+CREATE INDEX IF NOT EXISTS forms_gloss_id ON forms (gloss_id);
+'''
+
+# file extensions which we take to mean a lexeme database rather than a JSON file
+DB_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+def is_db_file(filename):
+    return filename is not None and filename.endswith(DB_EXTENSIONS)
+
+class LexemeStore:
+    '''A local SQLite database of languages, glosses and forms.
+    Unlike the JSON lexemes file, it does not have to be rewritten in full
+    every time a form is added.'''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _language_id(self, lang_name, lang_code):
+        self.conn.execute('INSERT OR IGNORE INTO languages (lang_name, lang_code) VALUES (?, ?)',
+                          (lang_name, lang_code))
+        self.conn.execute('UPDATE languages SET lang_code = ? WHERE lang_name = ?',
+                          (lang_code, lang_name))
+        return self.conn.execute('SELECT id FROM languages WHERE lang_name = ?',
+                                 (lang_name,)).fetchone()[0]
+
+    def _gloss_id(self, gloss):
+        self.conn.execute('INSERT OR IGNORE INTO glosses (gloss) VALUES (?)', (gloss,))
+        return self.conn.execute('SELECT id FROM glosses WHERE gloss = ?',
+                                 (gloss,)).fetchone()[0]
+
+    def add_entry(self, entry, glosses=None):
+        '''Adds an entry in the same format as in the lexemes JSON file
+        in one transaction. If no glosses are given, the forms are glossed by their position.'''
+        forms = entry['forms']
+        if isinstance(forms, str):
+            forms = [form.strip() for form in forms.split(',')]
+        if glosses is None:
+            glosses = [str(n) for n in range(1, len(forms) + 1)]
+        with self.conn:
+            lang_id = self._language_id(entry['lang_name'], entry['lang_code'])
+            for gloss, form in zip(glosses, forms):
+                gloss_id = self._gloss_id(gloss)
+                self.conn.execute('INSERT OR REPLACE INTO forms (lang_id, gloss_id, form) VALUES (?, ?, ?)',
+                                  (lang_id, gloss_id, form))
+
+    def languages(self):
+        '''Returns (lang_name, lang_code) pairs in the order they were added'''
+        return self.conn.execute('SELECT lang_name, lang_code FROM languages ORDER BY id').fetchall()
+
+    def glosses(self):
+        return [row[0] for row in self.conn.execute('SELECT gloss FROM glosses ORDER BY id')]
+
+    def word_lists(self, lang_codes=None):
+        '''Returns (lang_name, lang_code, [(gloss, form), ...]) for each language,
+        with only the forms it has, for when the forms aren't aligned by gloss yet'''
+        query = '''SELECT languages.id, lang_name, lang_code, gloss, form FROM forms
+                   JOIN languages ON languages.id = forms.lang_id
+                   JOIN glosses ON glosses.id = forms.gloss_id'''
+        params = []
+        if lang_codes is not None:
+            query += ' WHERE lang_code IN ({})'.format(', '.join('?' * len(lang_codes)))
+            params = list(lang_codes)
+        word_lists = []
+        last_id = None
+        for lang_id, lang_name, lang_code, gloss, form in self.conn.execute(
+                                        query + ' ORDER BY languages.id, glosses.id', params):
+            if lang_id != last_id:
+                word_lists.append((lang_name, lang_code, []))
+                last_id = lang_id
+            word_lists[-1][2].append((gloss, form))
+        return word_lists
+
+    def aligned_forms(self, lang_codes=None, batch=500):
+        '''Yields (gloss, [(lang_name, lang_code, form), ...]) for every gloss, with '-' for missing forms,
+        reading only batch glosses at a time, so that the whole table is never in memory.
+        The key is left out.'''
+        lang_query = "SELECT id, lang_name, lang_code FROM languages WHERE lang_name != 'key' COLLATE NOCASE"
+        lang_params = []
+        if lang_codes is not None:
+            lang_query += ' AND lang_code IN ({})'.format(', '.join('?' * len(lang_codes)))
+            lang_params = list(lang_codes)
+        langs = self.conn.execute(lang_query + ' ORDER BY id', lang_params).fetchall()
+        last_id = 0
+        while True:
+            gloss_rows = self.conn.execute('SELECT id, gloss FROM glosses WHERE id > ? ORDER BY id LIMIT ?',
+                                           (last_id, batch)).fetchall()
+            if not gloss_rows:
+                break
+            found = {}
+            for gloss_id, lang_id, form in self.conn.execute(
+                    'SELECT gloss_id, lang_id, form FROM forms WHERE gloss_id BETWEEN ? AND ?',
+                    (gloss_rows[0][0], gloss_rows[-1][0])):
+                found[(gloss_id, lang_id)] = form
+            for gloss_id, gloss in gloss_rows:
+                yield (gloss, [(lang_name, lang_code, found.get((gloss_id, lang_id), '-'))
+                                    for lang_id, lang_name, lang_code in langs])
+            last_id = gloss_rows[-1][0]
+
+    def lexemes(self, lang_codes=None, glosses=None):
+        '''Returns entries in the format of the lexemes JSON file, with the forms as lists,
+        optionally only for the given language codes and/or glosses.
+        The key (if there is one) is always included.'''
+        lang_query = 'SELECT id, lang_name, lang_code FROM languages'
+        lang_params = []
+        if lang_codes is not None:
+            lang_query += ' WHERE lang_code IN ({}) OR lang_name = ? COLLATE NOCASE'.format(
+                                                            ', '.join('?' * len(lang_codes)))
+            lang_params = list(lang_codes) + ['key']
+        gloss_query = 'SELECT id, gloss FROM glosses'
+        gloss_params = []
+        if glosses is not None:
+            gloss_query += ' WHERE gloss IN ({})'.format(', '.join('?' * len(glosses)))
+            gloss_params = list(glosses)
+
+        langs = self.conn.execute(lang_query + ' ORDER BY id', lang_params).fetchall()
+        gloss_rows = self.conn.execute(gloss_query + ' ORDER BY id', gloss_params).fetchall()
+        gloss_ids = [row[0] for row in gloss_rows]
+        gloss_names = [row[1] for row in gloss_rows]
+
+        lexemes = []
+        for lang_id, lang_name, lang_code in langs:
+            # the forms of glosses that weren't asked for are left out here, not in the query,
+            # which would need a parameter for every gloss
+            found = dict(self.conn.execute('SELECT gloss_id, form FROM forms WHERE lang_id = ?', (lang_id,)))
+            # a dash stands for a missing form, same as in the JSON file
+            forms = [found.get(gloss_id, '-') for gloss_id in gloss_ids]
+            lexemes.append({'lang_name': lang_name, 'lang_code': lang_code,
+                            'forms': forms, 'glosses': gloss_names})
+        return lexemes
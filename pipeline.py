@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# reconstructing datasets too big for memory, a window of cognate sets at a time
+# pylexemes
+
+import argparse, os, queue, re, sqlite3, sys, threading, time
+import collections as c
+import itertools as i
+from helpers import FormParser, Form, CognateSet, FormParsingError
+from lexemestore import LexemeStore, is_db_file
+from corpusfile import CorpusFile, MAGIC
+from reconstructor import Reconstructor
+from scheduler import CostModel
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+# JSON files bigger than this aren't read (see read_json)
+MAX_JSON_SIZE = 32 << 20
+
+def _statm_rss(pid):
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def _child_pids():
+    '''The processes this one started, like the workers of a pool'''
+    pids = []
+    parent = str(os.getpid())
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the parent comes right after the name, which can have anything in it
+        if stat[stat.rfind(')') + 2:].split()[1] == parent:
+            pids.append(pid)
+    return pids
+
+def current_rss():
+    '''The memory this process and the ones it started (like pool workers) are using right now
+    (their resident set sizes added up) in bytes. Pages that workers share with this process
+    are counted for each of them, so it's on the high side.
+    Where that can't be told, it's the most this process has ever used.'''
+    try:
+        rss = _statm_rss('self')
+    except (OSError, ValueError, IndexError):
+        rss = None
+    if rss is not None:
+        for pid in _child_pids():
+            try:
+                rss += _statm_rss(pid)
+            except (OSError, ValueError, IndexError):
+                # it's gone already
+                pass
+        return rss
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere but on the Mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# sources: all they have to be is iterables of cognate sets,
+# and these only make the Form objects of a set when it's read
+
+def build_set(sp, gloss, forms):
+    '''A cognate set from (lang_name, lang_code, form) triples, where '-' means the language has no form'''
+    cognate_set = CognateSet()
+    for lang_name, lang_code, form in forms:
+        # unknown language codes are made up the same way as by FormParser
+        lang_code = FormParser._get_lang_code(lang_code, lang_name)
+        if form == '-':
+            cognate_set.mark_missing(lang_code)
+        else:
+            cognate_set.add(Form(sp.parse(form), lang_code=lang_code, gloss=gloss))
+    return cognate_set
+
+def read_corpus(filename, sp=None):
+    '''Cognate sets from a compiled corpus, which stays on disk (memory-mapped)'''
+    with CorpusFile(filename, sp or FormParser.sp) as corpus:
+        yield from corpus
+
+def read_database(filename, sp=None, lang_codes=None, batch=500):
+    '''Cognate sets from a lexeme database, batch glosses at a time'''
+    sp = sp or FormParser.sp
+    store = LexemeStore(filename)
+    try:
+        for gloss, forms in store.aligned_forms(lang_codes, batch):
+            yield build_set(sp, gloss, forms)
+    finally:
+        store.close()
+
+def read_json(filename, sp=None, lang_codes=None, max_size=MAX_JSON_SIZE):
+    '''Cognate sets from a lexemes JSON file. Each entry of the file is a language,
+    so the whole file has to be read before the first set can be made, and the memory
+    that takes goes with the size of the dataset. Files bigger than max_size (in bytes)
+    aren't read at all: they should be compiled into a corpus or put in a lexeme database,
+    which are read a window at a time.'''
+    size = os.path.getsize(filename)
+    if max_size is not None and size > max_size:
+        raise FormParsingError('{} is {:.0f} MB, too big to read a window at a time as JSON. '
+                               'Compile it first (corpusfile.py -f {}) and use the compiled corpus, '
+                               'or put it in a lexeme database.'.format(filename, size / (1 << 20), filename))
+    return _json_sets(filename, sp or FormParser.sp, lang_codes)
+
+def _json_sets(filename, sp, lang_codes):
+    langs = []
+    glosses = None
+    for entry in json.load(open(filename)):
+        if entry['lang_name'].casefold() == 'key':
+            continue
+        if lang_codes is not None and entry['lang_code'] not in lang_codes:
+            continue
+        langs.append((entry['lang_name'], entry['lang_code'], FormParser._split_forms(entry['forms'])))
+        glosses = entry.get('glosses', glosses)
+    for n in range(len(langs[0][2]) if langs else 0):
+        gloss = glosses[n] if glosses is not None else None
+        yield build_set(sp, gloss, [(lang_name, lang_code, forms[n]) for lang_name, lang_code, forms in langs])
+
+def open_source(filename, sp=None, lang_codes=None, max_json_size=MAX_JSON_SIZE):
+    '''Reads cognate sets from a compiled corpus, a lexeme database or a (small enough) lexemes JSON file'''
+    if is_db_file(filename):
+        return read_database(filename, sp, lang_codes)
+    with open(filename, 'rb') as f:
+        compiled = f.read(len(MAGIC)) == MAGIC
+    if compiled:
+        return read_corpus(filename, sp)
+    return read_json(filename, sp, lang_codes, max_json_size)
+
+# sinks: they get every reconstruction as soon as it's done, and are flushed after every window
+
+class NDJSONSink:
+    '''Writes a JSON line for each cognate set'''
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w', encoding='utf-8')
+
+    def write(self, n, gloss, rec):
+        self.file.write(json.dumps({'n': n, 'gloss': gloss, 'rec': rec},
+                                   ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class SQLiteSink:
+    '''Writes a row for each cognate set to a table of an SQLite database.
+    With n_best, the reconstruction is the JSON list of the best ones with their scores.'''
+
+    def __init__(self, filename, table='reconstructions'):
+        if not re.match(r'^\w+$', table):
+            raise ValueError('Not a table name: {}'.format(table))
+        self.conn = sqlite3.connect(filename)
+        self.table = table
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS {} (
+                                     n INTEGER PRIMARY KEY,
+                                     gloss TEXT,
+                                     reconstruction TEXT NOT NULL
+                                 )'''.format(table))
+        self.rows = []
+
+    def write(self, n, gloss, rec):
+        if not isinstance(rec, str):
+            rec = json.dumps(rec, ensure_ascii=False)
+        self.rows.append((n, gloss, rec))
+
+    def flush(self):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO {} (n, gloss, reconstruction) VALUES (?, ?, ?)'.format(
+                                    self.table), self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+class CallbackSink:
+    '''Calls a function with the number, gloss and reconstruction of each cognate set'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, n, gloss, rec):
+        self.callback(n, gloss, rec)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def open_sink(filename):
+    '''An SQLite sink for a database file, and an NDJSON one for anything else'''
+    if is_db_file(filename):
+        return SQLiteSink(filename)
+    return NDJSONSink(filename)
+
+class Pipeline:
+    '''Reconstructs cognate sets from any source (an iterable of them) into a sink,
+    never holding more than a few windows of sets at once: one being reconstructed
+    and up to prefetch more read ahead by a thread of their own.
+
+    With a memory limit (in bytes), the reader is held back whenever the process
+    (with its workers) is over it: it waits for the windows it has read ahead to be done,
+    and reads smaller windows until memory goes down again (back up to the full size, doubling each time).
+    If there's nothing left to wait for, it goes on a set at a time, so it never gets stuck.
+
+    In parallel, each window is reconstructed by a pool of its own, with the window in shared memory,
+    so the workers never hold more than a window either.'''
+
+    def __init__(self, engine=None, sink=None, window=500, prefetch=1, memory_limit=None,
+                 parallel=True, progress=None, costs=None):
+        self.engine = engine if engine is not None else Reconstructor()
+        self.sink = sink
+        self.window = window
+        self.prefetch = prefetch
+        self.memory_limit = memory_limit
+        self.parallel = parallel
+        self.progress = progress
+        # one cost model for all the windows, so what's learned in one goes to the next
+        self.costs = costs if costs is not None else CostModel()
+        self.stats = c.Counter()
+        # how many times the reader was held back, and the most memory the process (and its workers) used
+        self.stalls = 0
+        self.peak_rss = 0
+        self._freed = threading.Condition()
+        self._busy = False
+
+    def _over_limit(self):
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        return self.memory_limit is not None and rss > self.memory_limit
+
+    def _read(self, cognate_sets, windows):
+        '''Runs in the reader thread: puts (number of the first set, sets) on windows, then None'''
+        try:
+            sets = iter(cognate_sets)
+            size = self.window
+            start = 0
+            while True:
+                if self._over_limit():
+                    self.stalls += 1
+                    size = max(1, size // 2)
+                    with self._freed:
+                        while self._over_limit() and (self._busy or not windows.empty()):
+                            self._freed.wait(1.0)
+                elif size < self.window:
+                    size = min(self.window, size * 2)
+                window = list(i.islice(sets, size))
+                if not window:
+                    break
+                windows.put((start, window))
+                start += len(window)
+                del window
+            windows.put(None)
+        except BaseException as e:
+            windows.put(e)
+
+    def run(self, cognate_sets):
+        '''Reconstructs all the sets, writing them to the sink, and returns how many there were'''
+        windows = queue.Queue(maxsize=self.prefetch)
+        reader = threading.Thread(target=self._read, args=(cognate_sets, windows), daemon=True)
+        reader.start()
+        done = 0
+        try:
+            while True:
+                item = windows.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                start, window = item
+                with self._freed:
+                    self._busy = True
+                for n, rec in self.engine.iter_reconstruct(window, self.parallel, progress=self.progress,
+                                                           stats=self.stats, costs=self.costs):
+                    # the forms of a set all have the same gloss
+                    gloss = next((form.gloss for form in window[n]), None)
+                    self.sink.write(start + n, gloss, rec)
+                self.sink.flush()
+                done += len(window)
+                del item, window
+                self._over_limit()
+                with self._freed:
+                    self._busy = False
+                    self._freed.notify_all()
+        finally:
+            self.sink.close()
+        reader.join()
+        return done
+
+def parse_size(size):
+    '''Bytes from a size like 512M or 2G (plain numbers are megabytes)'''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * units['M'])
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='reconstruct a dataset a window of cognate sets at a time, so it never has to fit in memory')
+    argparser.add_argument('-f', '--lexemesfile', type=str, required=True, help='lexemes file (JSON or SQLite database) or compiled corpus')
+    argparser.add_argument('-o', '--output', type=str, required=True, help='where to write the reconstructions: an SQLite database (.db, .sqlite) or a JSON lines file')
+    argparser.add_argument('--langs', type=str, nargs='+', help='only use the languages with these codes')
+    argparser.add_argument('-w', '--window', type=int, default=500, help='number of cognate sets to read at a time')
+    argparser.add_argument('-m', '--memory-limit', type=str, help='hold back reading while the process and its workers use more memory than this (like 512M or 2G)')
+    argparser.add_argument('--max-json-size', type=str, default='32M', help='refuse lexemes JSON files bigger than this, which have to be read whole (compile them or put them in a database instead)')
+    argparser.add_argument('-k', '--n-best', type=int, help='write the k best reconstructions of each set')
+    argparser.add_argument('--serial', action='store_true', help='reconstruct in this process instead of in a pool of workers')
+    argparser.add_argument('--costs', type=str, help='file to keep how long cognate sets took in, to start the longest first in later runs')
+    args = argparser.parse_args()
+
+    engine = Reconstructor(FormParser.sp, n_best=args.n_best)
+    costs = CostModel(args.costs)
+    pipeline = Pipeline(engine, open_sink(args.output), args.window,
+                        memory_limit=parse_size(args.memory_limit) if args.memory_limit else None,
+                        parallel=not args.serial, costs=costs)
+    start = time.time()
+    try:
+        done = pipeline.run(open_source(args.lexemesfile, lang_codes=args.langs,
+                                        max_json_size=parse_size(args.max_json_size)))
+    finally:
+        costs.save()
+    print('Reconstructed {} cognate sets into {} in {:.1f} s (peak memory {:.0f} MB, held back {} times)'.format(
+            done, args.output, time.time() - start, pipeline.peak_rss / (1 << 20), pipeline.stalls))
@@ -4,158 +4,502 @@
 
 import collections as c
 import itertools as i
-import difflib, argparse, pprint
+import difflib, argparse, pprint, heapq, os, threading, time
 from operator import itemgetter
-from multiprocessing import Pool
+from multiprocessing import Pool, get_start_method
+from multiprocessing.util import Finalize
 # imports of helper classes
-from helpers import SegmentParser, FormParser, Form, CognateSet
-
-def calculate_reconstruction_ratios(reconstructions):
-    # calculate the similarity ratios of each form to the provisional reconstruction
-    ratios = []
-    for prov_rec, root in zip(reconstructions, forms):
-        cur_root_ratios = []
-        for lexeme in root:
-            cur_root_ratios.append(sim_ratio(lexeme, prov_rec))
-        ratios.append(cur_root_ratios)
-    
-    avg_ratio_lang = {}
-    
-    for lang in lang_codes:
-        lang_ratios = [root[lang_codes.index(lang)][2] for root in ratios if root[lang_codes.index(lang)][2] != 0]
-        avg_ratio_lang[lang] = sum(lang_ratios)/len(lang_ratios)
-    
-    lang_ratios = [avg_ratio_lang[lang] for lang in avg_ratio_lang]
-    
-    return lang_ratios
+from helpers import SegmentParser, FormParser, Form, CognateSet, Progress, features_to_bits, popcount, form_bits, edit_ratio, edit_ratios, dataset_key
+from sharedcorpus import SharedCorpus, AttachedCorpus
+from checkpoint import Checkpoint
+from scheduler import CostModel, Scheduler
+try:
+    import numpy as np
+except ImportError:
+    from warnings import warn
+    warn('numpy not found. Segment groups will be compared as bitsets, which is slower.')
+    np = None
 
-# functions
-def run_reconstruct(cognate_sets):
-    
-    # a pool for asynchronous reconstructions
-    pool = Pool(processes=len(cognate_sets))
-    
-    # asynchronously reconstruct the forms
-    prov_recs = pool.map(reconstruct, cognate_sets)
-    
-    # do the reconstructions
-    if args.verbose:
-        print('Unbiased reconstructions: {}'.format(prov_recs))
-    
-    cut_forms = drop_bad_forms(cognate_sets, prov_recs)
-    
-    for n, (cut_form, prov_rec) in enumerate(zip(cut_forms, prov_recs)):
-        cut_forms[n] = cut_form + [prov_rec]
-    
-    reconstruction = pool.map(reconstruct, cut_forms)
+class Reconstructor:
+    '''The reconstruction engine. It keeps its segment inventory, settings and caches
+    to itself, so it can be imported and embedded, and one engine can be shared
+    by the threads of a thread pool: nothing changes after it's made except the caches,
+    and those are guarded by a lock.'''
 
-    return reconstruction
+    # the cheap bounds tried by drop_bad_forms. The first one has to bound the ratios
+    # from below as well, or the average can't be bounded and nothing can be decided.
+    # 'skeleton' can go after it, but a vowel in place of a consonant only costs a feature
+    # or two of the edit distance, so it hardly ever decides a form and costs more than it saves
+    filter_stages = ('diagonal',)
 
-    
-def reconstruct(cognate_set):
-    """Reconstructs multiple forms of a single cognate set
-    based on frequency of each feature in each segment of the cognate set."""
-
-    symbol_groups = assemble_groups(cognate_set)
-    matched_features = symbols_to_features(symbol_groups)
-    if args.verbose > 2:
-        pp.pprint(matched_features)
-    features = rearrange_groups(matched_features)
-    most_prom_f = most_prom_feat(features)
-    symbols = features_to_symbols(most_prom_f, sp.symbols, sp.features)
-    return symbols[0]
-
-def drop_bad_forms(forms, prov_recs):
-    cut_forms = []
-    
-    for root, prov_rec in zip(forms, prov_recs):
-        ratio_pairs = [sim_ratio(form, prov_rec) for form in root if form != '-']
-        ratios = [rp[2] for rp in ratio_pairs]
-        threshold = sum(ratios)/len(ratios)
-        # cut_root = [rp[0] for rp in ratio_pairs if rp[2] >= threshold]
-        cut_root = []
-        for rp in ratio_pairs:
-            if rp[2] >= threshold:
-                # increase the number of roots for greater accuracy (ha-ha)
-                #for n in range(round(rp[2] * 10)):
-                cut_root.append(rp[0])
-        cut_forms.append(cut_root)
-    
-    return cut_forms
+    def __init__(self, sp=None, verbose=0, n_best=None, processes=None):
+        if sp is None:
+            sp = SegmentParser()
+        self.sp = sp
+        self.verbose = verbose
+        # with n_best, the n best final reconstructions of each set are given with their scores
+        self.n_best = n_best
+        self.processes = processes
 
-def run_biased(forms, prov_recs, times):
-    for n in range(times):
-        (forms, prov_recs) = biased_reconstruct(forms, prov_recs)
-    return prov_recs
-    
-# def tokenise(forms):
-#     '''Splits forms into separate phonemes using split_polysymbols'''
-#     tokens = []
-#     # check if it's a list of forms or just one form as a string
-#     if type(forms) is list:
-#         tokens = [split_polysymbols(form) for form in forms]
-#     else:
-#         tokens = split_polysymbols(forms)
-#     return tokens
-    
-# def split_polysymbols(form):
-#     doc = "Splits a form into separate phonemes, detecting polysymbollic phonemes such as affricates."
-#     splitform = []
-#     # this list will contain the indexes of polysymbollic phonemes in our form
-#     indexes = []
-#     polysymbols = sp.polysymbols
-    
-#     # iterate over the polysymbols to get the indexes
-#     for polysymbol in polysymbols:
-#         # temporary form variable to remove polysymbols already accounted for
-#         t_form = form
-#         count = 0
-#         mc = form.count(polysymbol)
-#         while count < mc:
-#             # the start index in the temporary form
-#             t_form_index = t_form.find(polysymbol)
-#             # difference in lengths between the t_form and the real form
-#             diff = (len(form) - len(t_form))
-#             # actual start index
-#             real_start_index = t_form_index + diff
-#             endindex = real_start_index + len(polysymbol)
-            
-#             indexes.append((real_start_index, endindex))
-#             # slice the t_form so that the part up to which the polysymbol is in is no longer there
-#             t_form = t_form[(endindex - diff):]
-#             count += 1
-    
-#     # if there are no polysymbollic phonemes in this form, then just split it as a list
-#     if indexes == []:
-#         return list(form)
-#     # otherwise split it according to the indexes of polysymbols
-#     else:
-#         ls = list(form)
+        # the inventory as lists of features, to match theoretical segments against;
+        # when several symbols have the same features, the first one wins
+        self.symbol_features = {}
+        for symbol in sp.symbols:
+            self.symbol_features.setdefault(tuple(sp.features[symbol]._asdict().items()), symbol)
+        # the same for segments with diacritics, made the first time they're needed
+        self._composed_features = None
+        # guesses for theoretical segments that aren't in the inventory
+        self._guesses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        '''The settings, which is all it takes (with the inventory) to make the same engine again'''
+        return {'verbose': self.verbose, 'n_best': self.n_best, 'processes': self.processes}
+
+    def reconstruct_one(self, cognate_set):
+        '''Reconstructs a single cognate set'''
+        return self.reconstruct_set(cognate_set)[2]
+
+    def reconstruct_many(self, cognate_sets, parallel=True, stats=None):
+        '''Reconstructs all the cognate sets and returns the reconstructions in order.
+        Without parallel everything is done in the calling thread, which is what
+        you want when the engine is already being used from a thread pool or a worker.'''
+        if stats is None:
+            stats = c.Counter()
+        reconstruction = [None for cognate_set in cognate_sets]
+        for n, rec in self.iter_reconstruct(cognate_sets, parallel, stats=stats):
+            reconstruction[n] = rec
+        if self.verbose:
+            self.print_stats(stats)
+        return reconstruction
+
+    def print_stats(self, stats):
+        '''Shows how much work the filter stages and the skipped groups saved'''
+        decided = {stage: stats[stage] for stage in self.filter_stages + ('full',) if stats[stage]}
+        print('Forms decided by each filter stage: {}'.format(decided))
+        print('Homogeneous groups skipped: {} of {} when rearranging, {} when dropping segments'.format(
+                stats['regroup_skipped'], stats['groups'], stats['drop_skipped']))
+        print('Second pass positions: {} kept, {} updated, {} counted from scratch'.format(
+                stats['votes_kept'], stats['votes_updated'], stats['votes_counted']))
+
+    def iter_reconstruct(self, cognate_sets, parallel=True, ordered=True, progress=None, stats=None,
+                         checkpoint=None, costs=None):
+        '''Reconstructs the cognate sets and yields (number of the set, reconstruction)
+        for each set as soon as it's done, in order or not. Nothing waits for the whole dataset.
+        progress gets updated after every set, and the stats of every set are added to stats.
+        Every finished set is added to the checkpoint, and the sets the checkpoint
+        already has are not done again.
+        In parallel, the sets that should take longest are started first, as estimated
+        by the cost model (costs), which learns from how long each set took.
+        In order, the sets that are done early wait for the ones before them, so only
+        the sets a few places ahead of the first one not done yet are started, longest first.'''
+        done = {}
+        first_passes = {}
+        if checkpoint is not None:
+            for n in range(len(cognate_sets)):
+                rec = checkpoint.done(n)
+                if rec is not None:
+                    done[n] = rec
+                elif checkpoint.first_pass(n) is not None:
+                    first_passes[n] = checkpoint.first_pass(n)
+        pending = [n for n in range(len(cognate_sets)) if n not in done]
+        if costs is None:
+            costs = CostModel()
+
+        pool = None
+        if parallel and pending:
+            # the workers attach to the inventory and the corpus in shared memory
+            # so all they get sent is the number of the set
+            shared = SharedCorpus(cognate_sets, self.sp)
+
+            # a pool for asynchronous reconstructions, each worker with an engine of its own
+            processes = min(len(pending), self.processes or os.cpu_count() or 1)
+            # forked workers get the parser as it is, anywhere else it would have to be pickled,
+            # so they make their own from the shared tables
+            inherited = self.sp if get_start_method() == 'fork' else None
+            pool = Pool(processes=processes,
+                        initializer=attach_corpus, initargs=(shared.names, self.config, inherited))
+            # a couple of sets per worker are sent ahead, so none of them waits for the next one,
+            # and in order, the sets can only get a few places ahead of the first one not done yet
+            scheduler = Scheduler(costs, cognate_sets, 2 * processes)
+            results = scheduler.run(pool, reconstruct_set_shared,
+                                    {n: (n, first_passes.get(n)) for n in pending},
+                                    4 * processes if ordered else None)
+        else:
+            scheduler = Scheduler(costs, cognate_sets, 1)
+            results = (timed_reconstruct(self, n, cognate_sets[n], first_passes.get(n))
+                            for n in pending)
+
+        def finished():
+            for n, prov_rec, kept, rec, set_stats, seconds in results:
+                if self.verbose:
+                    print('Unbiased reconstruction: {}'.format(prov_rec))
+                if stats is not None:
+                    stats.update(set_stats)
+                if pool is None:
+                    scheduler.record(n, seconds)
+                if checkpoint is not None:
+                    checkpoint.add(n, prov_rec, kept, rec)
+                yield (n, rec)
+
+        if ordered:
+            def in_order():
+                # the sets from the checkpoint go back in their places,
+                # and sets that came back early wait here for their turn
+                waiting = done
+                finished_sets = finished()
+                for n in range(len(cognate_sets)):
+                    while n not in waiting:
+                        m, rec = next(finished_sets)
+                        waiting[m] = rec
+                    yield (n, waiting.pop(n))
+            all_sets = in_order()
+        else:
+            all_sets = i.chain(sorted(done.items()), finished())
+
+        complete = False
+        try:
+            for n, rec in all_sets:
+                if progress is not None:
+                    progress.update()
+                yield (n, rec)
+            complete = True
+        finally:
+            if pool is not None:
+                # workers that are let finish close their blocks on the way out,
+                # the rest are stopped (and the system lets go of theirs)
+                if complete:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+                shared.unlink()
+
+    def reconstruct_set(self, cognate_set, first_pass=None):
+        '''Reconstructs a cognate set twice: the second time only with the forms
+        that were similar enough to the first reconstruction, and with the reconstruction itself.
+        The second pass starts from the feature counts of the first, so only the changes are counted.
+        If the first pass is given (as the provisional reconstruction and the kept forms),
+        only the second one is done.
+        Returns the provisional reconstruction, the kept forms as (language, form) pairs,
+        the final reconstruction, and the stats (forms decided by each filter stage and skipped groups).'''
+        stats = c.Counter()
+        votes = None
+        if first_pass is None:
+            prov_rec, votes = self._reconstruct(assemble_groups(cognate_set), stats=stats)
+            cut_form = self.drop_bad_forms([cognate_set], [prov_rec], stats)[0]
+        else:
+            prov_rec, kept = first_pass
+            kept = {tuple(form) for form in kept}
+            cut_form = [form for form in cognate_set if (form.lang_code, str(form)) in kept]
+        cut_set = CognateSet(set(cut_form))
+        dropped = [form for form in cognate_set if form not in cut_set.forms]
+        prov_form = self.to_form(prov_rec)
+        added = [] if prov_form in cut_set.forms else [prov_form]
+        cut_set.add(prov_form)
+
+        cut_groups = assemble_groups(cut_set)
+        if votes is not None:
+            votes = votes.warm([group_features(group) for group in cut_groups], dropped, added, stats)
+        rec = self._reconstruct(cut_groups, self.n_best, stats, votes)[0]
+        kept = [(form.lang_code, str(form)) for form in cut_form]
+        return (prov_rec, kept, rec, stats)
+
+    def reconstruct(self, cognate_set, n_best=None, stats=None):
+        """Reconstructs multiple forms of a single cognate set
+        based on frequency of each feature in each segment of the cognate set.
+        With n_best, returns the n best reconstructions and their scores instead.
+        The numbers of groups that needed no rearranging are added to stats."""
+        return self._reconstruct(assemble_groups(cognate_set), n_best, stats)[0]
+
+    def _reconstruct(self, symbol_groups, n_best=None, stats=None, votes=None):
+        '''Reconstructs from the assembled segment groups, with the votes
+        for them if they're known already. Returns the votes along with the reconstruction.'''
+        if votes is None:
+            votes = Votes([group_features(group) for group in symbol_groups])
+        # rearranging moves segments around, so it gets groups of its own
+        matched_features = [list(group) for group in votes.feature_groups if group != []]
+        if self.verbose > 2:
+            pprint.pprint(matched_features)
+        features = rearrange_groups(matched_features, stats, votes.prominent_features())
+        most_prom_f = most_prom_feat(features)
+        if n_best:
+            return (self.beam_search(most_prom_f, n_best), votes)
+        symbols = self.features_to_symbols(most_prom_f)
+        return (symbols[0], votes)
+
+    def drop_bad_forms(self, forms, prov_recs, stats=None):
+        '''Drops the forms which are less similar to their provisional reconstruction
+        than the average form. Cheap bounds on the similarity are tried first,
+        and the full sim_ratio is only run for the forms that they can't decide,
+        giving up on a form as soon as it can't reach the lowest the average can be.
+        If stats is a Counter, the number of forms decided at each stage is added to it.'''
+        cut_forms = []
         
-#         # the value by which we'll adjust the indexing calls
-#         # because the length of the list is going to decrease as we go through
-#         adjust = 0
+        for root, prov_rec in zip(forms, prov_recs):
+            prov_rec = self.to_form(prov_rec)
+            # missing forms aren't in the cognate set to begin with
+            root = list(root)
+            if root == []:
+                cut_forms.append([])
+                continue
+            # the lowest and the highest that the ratio of each form can be
+            bounds = [(0.0, 1.0) for form in root]
+            # whether each form stays, or None if we don't know yet
+            decisions = [None for form in root]
+
+            for stage_name in self.filter_stages:
+                stage = getattr(self, stage_name + '_bound')
+                for n, form in enumerate(root):
+                    low, high = bounds[n]
+                    if decisions[n] is not None or low == high:
+                        continue
+                    stage_bounds = stage(form, prov_rec)
+                    if stage_bounds is not None:
+                        bounds[n] = (max(low, stage_bounds[0]), min(high, stage_bounds[1]))
+                decide_forms(bounds, decisions, stage_name, stats)
+                if None not in decisions:
+                    break
+            else:
+                # whatever's left needs the real thing, but only as far as it takes to tell
+                # that a form can't reach the lowest the average can be
+                undecided = [n for n in range(len(root)) if decisions[n] is None]
+                threshold = sum(b[0] for b in bounds) / len(bounds)
+                ratios = self.sim_ratios(prov_rec, [root[n] for n in undecided], threshold)
+                for n, ratio in zip(undecided, ratios):
+                    # under the threshold, the ratio is only as high as it can be
+                    bounds[n] = (ratio, ratio) if ratio >= threshold else (bounds[n][0], ratio)
+                decide_forms(bounds, decisions, 'full', stats)
+                if None in decisions:
+                    # the threshold itself is still too uncertain
+                    for n, form in enumerate(root):
+                        if bounds[n][0] != bounds[n][1]:
+                            ratio = self.sim_ratio(form, prov_rec)[2]
+                            bounds[n] = (ratio, ratio)
+                    decide_forms(bounds, decisions, 'full', stats)
+
+            # increase the number of roots for greater accuracy (ha-ha)
+            #for n in range(round(rp[2] * 10)):
+            cut_root = [form for form, keep in zip(root, decisions) if keep]
+            cut_forms.append(cut_root)
         
-#         for index in indexes:
-#             del ls[(index[0] - adjust):(index[1] - adjust)]
-#             ls.insert((index[0] - adjust), form[index[0]:index[1]])
-#             # adjust the next indexes according to the length of the polysymbol that we've just concatenated
-#             adjust += ((index[1] - index[0]) - 1)
-#         splitform = ls
-#         return splitform
-    
-# def avg_length(forms):
-#     doc = "Returns the average length of forms."
-#     lengths = [len(f) for f in forms]
-#     return round(sum(lengths)/len(lengths))
-    
-# def create_form_matrix(root, avglength):
-#     '''Creates a matrix for each form'''
-#     # trim each form to average length
-#     root = [form[:avglength] for form in root]
-#     print(root)
-#     return matrix(root)
-    
+        return cut_forms
+
+    def diagonal_bound(self, form, prov_rec):
+        '''Both bounds on sim_ratio: lining the segments up one by one (and putting in
+        whatever is left over) costs at least as much as the best way to edit one form into the other'''
+        bits1 = form_bits(form)
+        bits2 = form_bits(prov_rec)
+        if not bits1 or not bits2:
+            return (0.0, 0.0)
+        longest = max(len(bits1), len(bits2))
+        difference = abs(len(bits1) - len(bits2))
+        distance = (sum(popcount(b1 ^ b2) for b1, b2 in zip(bits1, bits2))
+                        + difference * self.sp.num_features)
+        return (1.0 - distance / (longest * self.sp.num_features), 1.0 - difference / longest)
+
+    def skeleton_bound(self, form, prov_rec):
+        '''An upper bound on sim_ratio from the CV skeletons of the forms, wherever the segments are:
+        every segment that one form has over the other has to be put in, and of the rest,
+        only as many can be paired with a segment of the same class as the forms have in common.
+        Segments of different classes differ in syl or cons, so every other pair costs a feature.'''
+        struct1 = form.structure
+        struct2 = prov_rec.structure
+        if not struct1 or not struct2:
+            return (0.0, 0.0)
+        longest = max(len(struct1), len(struct2))
+        shortest = min(len(struct1), len(struct2))
+        same = sum((c.Counter(struct1) & c.Counter(struct2)).values())
+        distance = (longest - shortest) * self.sp.num_features + shortest - same
+        return (0.0, 1.0 - distance / (longest * self.sp.num_features))
+
+    def composed_features(self):
+        '''The segments with one diacritic keyed by their features, like symbol_features'''
+        with self._lock:
+            if self._composed_features is None:
+                self._composed_features = {}
+                for segment in self.sp.composed_segments():
+                    self._composed_features.setdefault(tuple(segment.features._asdict().items()), segment.symbol)
+            return self._composed_features
+
+    def guess_segment(self, t_segment):
+        """Find the segment whose feature set has the highest similarity ratio with the theoretical 
+        segment, including the segments with diacritics. For two feature sets the ratio that
+        SequenceMatcher gives is the share of features that agree, so the bitsets are compared."""
+        key = tuple(t_segment)
+        with self._lock:
+            guessed = self._guesses.get(key)
+        if guessed is not None:
+            return guessed
+        bits = features_to_bits(value for name, value in t_segment)
+        guessed = None
+        fewest = None
+        candidates = [(symbol, self.sp.feature_bits[symbol]) for symbol in self.sp.features]
+        candidates += [(segment.symbol, segment.bits) for segment in self.sp.composed_segments()]
+        for symbol, symbol_bits in candidates:
+            differences = popcount(bits ^ symbol_bits)
+            # the first of the best ones wins
+            if fewest is None or differences < fewest:
+                guessed = symbol
+                fewest = differences
+        # two threads may both work it out, but they get the same answer
+        with self._lock:
+            self._guesses[key] = guessed
+        return guessed
+        
+    # match theoretical phonemes as features to IPA symbols in the database
+    def features_to_symbols(self, mcf):
+        matched_symbols = []
+        unmatched_features = []
+        for n, t_segment in enumerate(mcf):
+            symbol = self.symbol_features.get(tuple(t_segment))
+            if symbol is None and self.sp.diacritics:
+                # it could still be a segment with a diacritic
+                symbol = self.composed_features().get(tuple(t_segment))
+            if symbol is not None:
+                matched_symbols.append(symbol)
+            else:
+                # so, if there is no match for the theoretical segment that we've assembled, we're going to make an educated guess
+                # based on the similarity ratio between our theoretical segment and the phonemes in our database
+                # so the segment which has the highest similarity ratio with our theoretical segment gets picked
+                guessed_symbol = self.guess_segment(t_segment)
+                matched_symbols.append('(' + guessed_symbol + ')')
+                unmatched_features.append((n, t_segment))
+        unmatched_features = list(filter(None, unmatched_features))
+        return (''.join(matched_symbols), unmatched_features)
+        
+    def to_form(self, form):
+        '''Turns a reconstruction into a Form so that it can be compared with other forms'''
+        if isinstance(form, Form):
+            return form
+        # guessed segments are in brackets
+        return Form(self.sp.parse(form.replace('(', '').replace(')', '')))
+
+    def candidate_segments(self, t_segment, k):
+        '''Returns the k segments whose features are the most similar to the theoretical segment,
+        best first, as (ratio, symbol) pairs. The ratios are the same that SequenceMatcher gives.'''
+        bits = features_to_bits(value for name, value in t_segment)
+        scored = [(1.0 - popcount(bits ^ self.sp.feature_bits[symbol]) / len(t_segment), symbol)
+                    for symbol in self.sp.symbols]
+        scored += [(1.0 - popcount(bits ^ segment.bits) / len(t_segment), segment.symbol)
+                    for segment in self.sp.composed_segments()]
+        # ties stay in the order of the inventory, like in features_to_symbols,
+        # and the segments with diacritics come after all the others
+        return heapq.nlargest(k, scored, key=itemgetter(0))
+
+    def beam_search(self, mcf, k):
+        '''Finds the k best reconstructions for the theoretical segments,
+        keeping only the k best partial reconstructions at each position.
+        The score of a reconstruction is the average ratio of its segments.'''
+        beams = [(0.0, [])]
+        for t_segment in mcf:
+            candidates = self.candidate_segments(t_segment, k)
+            extended = []
+            for score, symbols in beams:
+                for ratio, symbol in candidates:
+                    # guesses are in brackets, same as in features_to_symbols
+                    if ratio < 1.0:
+                        symbol = '(' + symbol + ')'
+                    extended.append((score + ratio, symbols + [symbol]))
+            beams = heapq.nlargest(k, extended, key=itemgetter(0))
+        return [(''.join(symbols), score / len(mcf) if mcf else 0.0) for score, symbols in beams]
+
+    def sim_ratio(self, form1, form2, threshold=None, band=None):
+        '''How similar two forms are (0 to 1), from the feature-weighted edit distance between them,
+        so a segment put in or left out only costs that segment. Segments without features are left out.
+        With a threshold, a ratio under it is only an upper bound (it stops as soon as it knows),
+        and with a band, only alignments that many segments off the diagonal are tried.'''
+        # it's unlikely, but whatevs
+        if str(form1) == str(form2):
+            return (form1, form2, 1.0)
+        bits1 = form_bits(self.to_form(form1))
+        bits2 = form_bits(self.to_form(form2))
+        return (form1, form2, edit_ratio(bits1, bits2, self.sp.num_features, threshold, band))
+
+    def sim_ratios(self, form, others, threshold=None, band=None):
+        '''sim_ratio of one form against many, as a list of the ratios'''
+        form = self.to_form(form)
+        others = list(others)
+        # the same as the form, so there's nothing to work out
+        ratios = [1.0 if str(other) == str(form) else None for other in others]
+        different = [n for n, ratio in enumerate(ratios) if ratio is None]
+        found = edit_ratios(form_bits(form), [form_bits(self.to_form(others[n])) for n in different],
+                            self.sp.num_features, threshold, band)
+        for n, ratio in zip(different, found):
+            ratios[n] = ratio
+        return ratios
+
+    def calculate_reconstruction_ratios(self, reconstructions, forms, counts=None):
+        '''Returns the average similarity ratio of each language's forms to the reconstructions.
+        Forms with nothing in common with theirs are left out. If counts is a Counter,
+        the number of forms that went into each language's average is added to it.'''
+        lang_ratios = c.defaultdict(list)
+        for prov_rec, root in zip(reconstructions, forms):
+            root = list(root)
+            for lexeme, ratio in zip(root, self.sim_ratios(prov_rec, root)):
+                if ratio != 0:
+                    lang_ratios[lexeme.lang_code].append(ratio)
+        
+        avg_ratio_lang = {lang: sum(ratios)/len(ratios) for lang, ratios in lang_ratios.items()}
+        if counts is not None:
+            counts.update({lang: len(ratios) for lang, ratios in lang_ratios.items()})
+        
+        return avg_ratio_lang
+        
+    def test_recs(self, recs, true_recs, lang_ratios=None, threshold=0.85):
+        '''Compares the reconstructions to the true ones. The threshold is a ratio (0 to 1),
+        the percentages are only for showing. Sets that the key has no form for ('-')
+        are skipped, and left out of the average.'''
+        if true_recs == None:
+            return None
+        # threshold = sum(lang_ratios)/len(lang_ratios)
+        tests = []
+        ratios = []
+        for rec, true_rec in zip(recs, true_recs):
+            if true_rec == '-':
+                tests.append((rec, true_rec, None, 'skipped'))
+                continue
+            ratio = (self.sim_ratio(rec, true_rec))
+            ratios.append(ratio[2])
+            if ratio[2] >= threshold:
+                tests.append((rec, true_rec, (round((ratio[2] * 100), 1)), 'passed'))
+            else:
+                tests.append((rec, true_rec, (round((ratio[2] * 100), 1)), 'failed'))
+        if ratios == []:
+            return (tests, None)
+        avg = sum(ratios)/len(ratios)
+        if avg >= threshold:
+            result = (round(avg * 100, 1), 'success :)')
+        else:
+            result = (round(avg * 100, 1), 'failure :(')
+        return (tests, result)
+
+# the worker side of parallel reconstruction: each worker process gets an engine of its own
+_worker = None
+
+def attach_corpus(names, config, sp=None):
+    '''Runs in each worker to attach to the shared inventory and corpus,
+    and to let go of them when the worker is done'''
+    global _worker
+    attached = AttachedCorpus(*names, sp=sp)
+    _worker = (attached, Reconstructor(attached.sp, **config))
+    Finalize(attached, attached.close, exitpriority=10)
+
+def reconstruct_set_shared(task):
+    '''Reconstructs a cognate set from the shared corpus'''
+    n, first_pass = task
+    attached, engine = _worker
+    return timed_reconstruct(engine, n, attached.cognate_set(n), first_pass)
+
+def timed_reconstruct(engine, n, cognate_set, first_pass=None):
+    '''Reconstructs a set with its number in front of the results and the seconds it took at the end'''
+    start = time.perf_counter()
+    results = engine.reconstruct_set(cognate_set, first_pass)
+    return (n,) + results + (time.perf_counter() - start,)
+
+# the steps below only work on feature lists, so they don't need an engine
+
 def assemble_groups(cognate_set):
     """Assembles segment groups."""
     segment_groups = []
@@ -171,109 +515,182 @@ def assemble_groups(cognate_set):
                 continue
         segment_groups.append(current_group)
     return segment_groups
-    
-# def form_to_features(form):
-#     '''Converts a form as IPA symbols into its feature representation'''
-#     features = list(map(symbol_to_features, form))
-#     return features
-    
-# match phonemes to their features
-# def symbols_to_features(groups):
-#     matched_features = []
-#     # iterate over symbol groups
-#     for group in groups:
-#         # current symbol feature group
-#         cur_feat_g = []
-#         # keep only the good symbols
-#         good_symbols = [symbol for symbol in group if symbol in sp.symbols]
-#         # map symbols to features
-#         cur_feat_g = list(map(symbol_to_features, good_symbols))
-#         if cur_feat_g != []:
-#             matched_features.append(cur_feat_g)
-#     return matched_features
-    
-# def symbol_to_features(symbol, as_dict=False, true_only=False):
-#     """Retrieves features for a given IPA symbol"""
-#     features = sp.features.get(symbol)
-#     if features is None:
-#         return features
-#     if as_dict:
-#         return features
-#     else:
-#         features = features.items()
-#     if true_only:
-#         features = [feature for feature in features if feature[1]]
-    
-#     return list(features)
+
+def symbols_to_features(groups):
+    '''Maps groups of segments to groups of their features'''
+    matched_features = []
+    for group in groups:
+        cur_feat_g = group_features(group)
+        if cur_feat_g != []:
+            matched_features.append(cur_feat_g)
+    return matched_features
+
+def group_features(group):
+    # keep only the segments that we know the features of
+    return [list(segment.features._asdict().items())
+                for segment in group if segment.features is not None]
+
+def decide_forms(bounds, decisions, stage_name, stats):
+    '''Marks the forms which are certainly above or below the threshold (the average ratio)'''
+    threshold_low = sum(b[0] for b in bounds) / len(bounds)
+    threshold_high = sum(b[1] for b in bounds) / len(bounds)
+    for n, (low, high) in enumerate(bounds):
+        if decisions[n] is not None:
+            continue
+        if high < threshold_low or low >= threshold_high:
+            decisions[n] = low >= threshold_high
+            if stats is not None:
+                stats[stage_name] += 1
 
 # select most prominent features
-def most_prom_feat(segment_groups):
-    # collections module to get the most common property (see below)
+def most_prom_feat(segment_groups, keep_empty=False):
+    '''Returns the most common value of every feature in each group, leaving out empty groups.
+    With keep_empty, an empty group gets None instead, so that the list lines up with the groups.'''
     p_features = []
-    # iterate over groups of phonemic features
-    for group_n, groups in enumerate(matched_features):
-        # iterate over phonemes in each group
-        cur_group = []
-        for phoneme_n, phonemes in enumerate(groups):
-            cur_phon = []
-            # iterate over each feature (cons, son, round, etc.) in each phoneme
-            for prop_n, props in enumerate(phonemes):
-                cur_prop = []
-                # iterate over phonemes in each group again to get the feature at the same place
-                for n, x in enumerate(groups):
-                    # append the feature at that place to the list of properties at that place
-                    try:
-                        cur_prop.append(groups[n][prop_n])
-                    except Exception as e:
-                        continue
-                # append the most common feature at that place to list of features for current segment
-                cur_phon.append(c.Counter(cur_prop).most_common(1)[0][0])
-            # append the current theoretical segment to the list of phonemes as features
-            cur_group.append(cur_phon)
-        try:
-            if list(filter(None, cur_group)) != []:
-                p_features.append(cur_group[0])
-        # hack in case the group is a singleton
-        except:
-            p_features.append(cur_group)
-    
+    for group in segment_groups:
+        if group == []:
+            if keep_empty:
+                p_features.append(None)
+            continue
+        if is_homogeneous(group):
+            # everyone agrees, so there's nothing to count
+            p_features.append(list(group[0]))
+            continue
+        p_features.append(majority(group, *count_features(group)))
     return p_features
 
-def most_frequent_features(segment_groups):
+def count_features(group):
+    '''Returns the number of segments in a group and how many of them have each feature'''
+    if group == []:
+        return (0, None)
+    if np is not None:
+        return (len(group), [int(n) for n in feature_matrix(group).sum(axis=0)])
+    true = [0 for feature in group[0]]
+    for segment in group:
+        for n, (name, value) in enumerate(segment):
+            if value:
+                true[n] += 1
+    return (len(group), true)
 
-    for segment_group in segment_groups:
+def majority(group, size, true):
+    '''The prominent features from the counts of a group. A tie goes to the value
+    of the first segment, which is the one that Counter.most_common would pick.'''
+    prominent = []
+    for (name, value), n in zip(group[0], true):
+        if 2 * n > size:
+            prominent.append((name, True))
+        elif 2 * n < size:
+            prominent.append((name, False))
+        else:
+            prominent.append((name, value))
+    return prominent
 
-        for segment in segment_group:
+class Votes:
+    '''How many segments at each position of a cognate set have each feature,
+    before any rearranging, and the prominent features that come out of that.
+    The second pass works on the forms of the first minus the dropped ones
+    plus the provisional reconstruction, so its votes are made from the first
+    pass's by taking those out and putting that in.'''
 
-            features_at_cur_position = []
+    def __init__(self, feature_groups, counts=None, prominent=None):
+        # one group of feature sets for each position, empty ones included
+        self.feature_groups = feature_groups
+        if counts is None:
+            counts = [count_features(group) for group in feature_groups]
+        self.counts = counts
+        if prominent is None:
+            prominent = [majority(group, *count) if group != [] else None
+                            for group, count in zip(feature_groups, counts)]
+        self.prominent = prominent
 
-            for n, feature in enumerate(sp.features):
-                features_at_cur_position = [segment.features]
-        
-    
-def rearrange_groups(matched_features):
+    def prominent_features(self):
+        '''The prominent features of the groups that have any segments, same as most_prom_feat'''
+        return [p for p in self.prominent if p is not None]
+
+    def warm(self, feature_groups, dropped, added, stats=None):
+        '''Returns the votes for the positions in feature_groups, which are the same forms
+        as these votes were counted from except for the dropped and the added ones.
+        The prominent features of a position are only worked out again
+        if there are enough changes there to swing the majority of a feature.'''
+        counts = []
+        prominent = []
+        changed = [(form, -1) for form in dropped] + [(form, 1) for form in added]
+        for n, group in enumerate(feature_groups):
+            if n >= len(self.counts):
+                # the forms got longer on average, so this position wasn't there before
+                counts.append(count_features(group))
+                prominent.append(majority(group, *counts[-1]) if group != [] else None)
+                if stats is not None:
+                    stats['votes_counted'] += 1
+                continue
+
+            size, true = self.counts[n]
+            new_size = size
+            new_true = list(true) if true is not None else None
+            changes = 0
+            for form, sign in changed:
+                if n >= len(form) or form[n].bits is None:
+                    continue
+                changes += 1
+                new_size += sign
+                if new_true is None:
+                    new_true = [0 for feature in form[n].features]
+                bits = form[n].bits
+                for k in range(len(new_true)):
+                    if bits >> k & 1:
+                        new_true[k] += sign
+            counts.append((new_size, new_true if new_size else None))
+
+            if group == []:
+                prominent.append(None)
+            elif (self.prominent[n] is not None
+                    and all(abs(2 * t - size) > changes for t in true)):
+                # every feature had a big enough majority that it can't have changed
+                prominent.append(self.prominent[n])
+                if stats is not None:
+                    stats['votes_kept'] += 1
+            else:
+                prominent.append(majority(group, new_size, new_true))
+                if stats is not None:
+                    stats['votes_updated'] += 1
+        return Votes(feature_groups, counts, prominent)
+
+def is_homogeneous(group):
+    '''Whether all the segments in a group have the same features'''
+    return group != [] and all(segment == group[0] for segment in group)
+
+def rearrange_groups(matched_features, stats=None, mpf=None):
     '''This function rearranges the phoneme groups
     so that each phoneme is in the group which it belongs to by running the most_prom_feat functions preliminarily
-    and seeing whether the feature set of each phoneme.'''
+    and seeing whether the feature set of each phoneme.
+    Groups where every segment already is the prominent one are skipped (and counted in stats).
+    The preliminary most prominent features can be given if they're already known.'''
 
-    mpf = most_prom_feat(rearranged_features)
+    rearranged_features = matched_features
+    if mpf is None:
+        mpf = most_prom_feat(rearranged_features, keep_empty=True)
     for n, g in enumerate(rearranged_features):
         # get the most prominent features of current group
         try:
             mpfn = mpf[n]
         except:
             return rearranged_features
-        try:
-            # get the most prominent features of the previous group, if it exists
-            mpf0 = mpf[(n - 1)]
-        except:
-            # if not, then not
-            mpf0 = None
+        # get the most prominent features of the previous group, if it exists
+        # (the first group has none, mpf[-1] would be the last one)
+        mpf0 = mpf[n - 1] if n > 0 else None
         try:
             # get the most prominent features of the next group, if it exists
             mpf1 = mpf[(n + 1)]
         except:
             mpf1 = None
+        if stats is not None:
+            stats['groups'] += 1
+        # a segment that matches its own group fully could only be moved
+        # if a neighbouring group had the very same prominent features
+        if is_homogeneous(g) and g[0] == mpfn and not (mpf0 and mpf1 and mpfn in (mpf0, mpf1)):
+            if stats is not None:
+                stats['regroup_skipped'] += 1
+            continue
         for s in g:
             # calculate the ratio between this phoneme's features and the preliminary theoretical phoneme in the current group
             r = difflib.SequenceMatcher(None, s, mpfn).ratio()
@@ -304,147 +721,134 @@ def rearrange_groups(matched_features):
                     g.remove(s)
                     rearranged_features[n+1].append(s)
     # if there are still extraneous segments, let's just kill them
-    rearranged_features = drop_segments(rearranged_features)
+    rearranged_features = drop_segments(rearranged_features, stats)
     return rearranged_features
     
-def drop_segments(s_features):
+def drop_segments(s_features, stats=None):
     """Drops segments which are extraneous based on their similarity to the most prominent segment features in their group"""
-    mpf = most_prom_feat(s_features)
+    mpf = most_prom_feat(s_features, keep_empty=True)
     new_groups = []
     for n, g in enumerate(s_features):
         mpfn = mpf[n]
+        if mpfn is None:
+            # rearranging moved every segment out of this group
+            new_groups.append(g)
+            continue
+        if is_homogeneous(g) and g[0] == mpfn:
+            # every segment agrees fully with the prominent features, and so does the average
+            new_groups.append(g)
+            if stats is not None:
+                stats['drop_skipped'] += 1
+            continue
         threshold = avg_sg_ratio(g)
-        cut_segments = [segment for segment in g if difflib.SequenceMatcher(None, segment, mpfn).ratio() >= threshold]
+        if np is not None:
+            # agreement of every segment with the most prominent features at once
+            matrix = feature_matrix(g)
+            prominent = np.array([1 if value else 0 for name, value in mpfn], dtype=np.int8)
+            agreements = (matrix == prominent).sum(axis=1)
+            keep = agreements / len(mpfn) >= threshold
+            cut_segments = [segment for segment, k in zip(g, keep) if k]
+        else:
+            prominent = features_to_bits(value for name, value in mpfn)
+            cut_segments = [segment for segment in g
+                                if (len(mpfn) - popcount(group_bits(segment) ^ prominent)) / len(mpfn) >= threshold]
         new_groups.append(cut_segments)
     return new_groups
 
-def avg_sg_ratio(s_features):
-    """Returns the average similarity ratio for that segment group, used for thresholding"""
-    ratios = [difflib.SequenceMatcher(None, x, y).ratio() for x in s_features for y in s_features]
-    return sum(ratios)/len(ratios)
-    
+def feature_matrix(s_features):
+    """Returns the segment group as a matrix of 0s and 1s, one row per segment.
+    0 and False are the same here, just as they compare equal in the feature sets."""
+    return np.array([[1 if value else 0 for name, value in segment] for segment in s_features],
+                    dtype=np.int8)
 
-    
-def guess_segment(t_segment):
-   """Find the segment whose feature set has the highest similarity ratio with the theoretical 
-   segment."""
-   ratios = {}
-   for f in sp.features:
-      ratios[f] = difflib.SequenceMatcher(None, t_segment, list(sp.features[f].items())).ratio()
-   return max(ratios, key=ratios.get)
-    
-# match theoretical phonemes as features to IPA symbols in the database
-def features_to_symbols(mcf, symbols, features):
-    matched_symbols = []
-    symbols = []
-    list_features = []
-    for f in features:
-        symbols.append(f)
-        list_features.append(list(features[f].items()))
-    unmatched_features = []
-    for n, t_segment in enumerate(mcf):
-        if t_segment in list_features:
-            matched_symbols.append(symbols[list_features.index(t_segment)])
-        else:
-            # so, if there is no match for the theoretical segment that we've assembled, we're going to make an educated guess
-            # based on the similarity ratio between our theoretical segment and the phonemes in our database
-            # so the segment which has the highest similarity ratio with our theoretical segment gets picked
-            guessed_symbol = guess_segment(t_segment)
-            matched_symbols.append('(' + guessed_symbol + ')')
-            unmatched_features.append((n, t_segment))
-    unmatched_features = list(filter(None, unmatched_features))
-    return (''.join(matched_symbols), unmatched_features)
-    
-def sim_ratio(form1, form2):
-    # it's unlikely, but whatevs
-    if form1 == form2:
-        return (form1, form2, 1.0)
-    
-    f1_tokens = tokenise(form1)
-    f2_tokens = tokenise(form2)
-    
-    # this needs to be passed as a list cuz otherwise symbols_to_features thinks that every token is a group
-    try:
-        f1_features = (symbols_to_features([f1_tokens]))[0]
-        f2_features = (symbols_to_features([f2_tokens]))[0]
-    except IndexError:
-        return (form1, form2, 0.0)
-    
-    ratios = []
-    for segment1, segment2 in i.zip_longest(f1_features, f2_features, fillvalue=[]):
-        if segment1 == segment2:
-            ratios.append(1.0)
-        elif segment1 == [] or segment2 == []:
-            # still don't really know what to do in this case
-            # because any clever trick I try leads to worse reconstructions
-            # like the one below, for instance
-            # try:
-            #     ratios.append((sum(ratios)/len(ratios)) ** (len(f1_features) - len(f2_features)))
-            # except ZeroDivisionError:
-            #     pass
-            break
-        else:
-            ratios.append(difflib.SequenceMatcher(None, segment1, segment2).ratio())
-    try:
-        ratio = sum(ratios)/len(ratios)
-    except ZeroDivisionError:
-        ratio = 0.0
-        # this looks like an owl in my font
-    return (form1, form2, ratio)
-    
-def test_recs(recs, true_recs, lang_ratios):
-    if true_recs == None:
-        return None
-    # threshold = sum(lang_ratios)/len(lang_ratios)
-    threshold = 0.85
-    tests = []
-    for rec, true_rec in zip(recs, true_recs):
-        ratio = (sim_ratio(rec, true_rec))
-        if ratio[2] >= threshold:
-            tests.append((rec, true_rec, (round((ratio[2] * 100), 1)), 'passed'))
-        else:
-            tests.append((rec, true_rec, (round((ratio[2] * 100), 1)), 'failed'))
-    ratios = [test[2] for test in tests]
-    avg = sum(ratios)/len(ratios)
-    if avg >= threshold:
-        result = (round(avg, 1), 'success :)')
+def group_bits(segment):
+    return features_to_bits(value for name, value in segment)
+
+def avg_sg_ratio(s_features):
+    """Returns the average similarity ratio for that segment group, used for thresholding.
+    For two feature sets SequenceMatcher gives the share of features that agree,
+    so all the pairs can be compared in one go. The pairs are symmetrical, so only the
+    upper triangle is counted, and every segment agrees fully with itself."""
+    size = len(s_features)
+    if size == 0:
+        return 0.0
+    num_features = len(s_features[0])
+    if np is not None:
+        matrix = feature_matrix(s_features).astype(np.int32)
+        agreements = matrix @ matrix.T + (1 - matrix) @ (1 - matrix).T
+        upper = int(np.triu(agreements, k=1).sum())
     else:
-        result = (round(avg, 1), 'failure :(')
-    return (tests, result)
+        bits = [group_bits(segment) for segment in s_features]
+        upper = sum(num_features - popcount(bits[x] ^ bits[y])
+                        for x in range(size) for y in range(x + 1, size))
+    # kept as integers until the very end so that ties come out exactly
+    return (size * num_features + 2 * upper) / (size * size * num_features)
 
-def main():
+def main(args):
     print('Working...')
-    
-    reconstructions = run_reconstruct(lp.forms)
-    for r in reconstructions:
-        print(r)
+
+    lp = FormParser(args.lexemesfile, lang_codes=args.langs, glosses=args.glosses)
+    engine = Reconstructor(lp.sp, verbose=args.verbose, n_best=args.n_best)
+    
+    checkpoint = None
+    if not args.no_checkpoint:
+        checkpoint = Checkpoint(args.checkpoint or args.lexemesfile + '.ckpt',
+                                dataset_key(lp.forms, lp.sp), args.n_best, args.resume)
+    # how long sets took before, to start the longest ones first
+    costs = CostModel(args.costs)
+    
+    progress = Progress(len(lp.forms)) if args.progress else None
+    # only kept if we need them for the tests
+    reconstructions = [None for cognate_set in lp.forms] if args.test else None
+    stats = c.Counter()
+    try:
+        for n, r in engine.iter_reconstruct(lp.forms, ordered=not args.unordered, progress=progress,
+                                            stats=stats, checkpoint=checkpoint, costs=costs):
+            if args.n_best:
+                output = ', '.join('{} ({})'.format(rec, round(score, 3)) for rec, score in r)
+                # only the best ones get tested
+                r = r[0][0]
+            else:
+                output = r
+            if args.unordered:
+                output = '{}: {}'.format(n + 1, output)
+            print(output, flush=True)
+            if reconstructions is not None:
+                reconstructions[n] = r
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        costs.save()
+    # the run is finished, so there's nothing left to resume
+    if checkpoint is not None:
+        checkpoint.remove()
+    if args.verbose:
+        engine.print_stats(stats)
     
     # do the tests
     if args.test:
-        ratios = calculate_reconstruction_ratios(reconstructions)
-        test_result = test_recs(reconstructions, lp.true_recs, ratios)
-        pp.pprint(test_result)
+        ratios = engine.calculate_reconstruction_ratios(reconstructions, lp.forms)
+        test_result = engine.test_recs(reconstructions, lp.true_recs, ratios, args.threshold)
+        pprint.pprint(test_result)
 
 if __name__ == "__main__":
     # arguments
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-v', '--verbose', action='count', default=0, help='varying levels of output verbosity')
     argparser.add_argument('-l', '--log', action='store_true', help='create a log of reconstruction')
-    argparser.add_argument('-f', '--lexemesfile', type=str, help='specify a lexemes file')
+    argparser.add_argument('-f', '--lexemesfile', type=str, help='specify a lexemes file (JSON or SQLite database)')
+    argparser.add_argument('--langs', type=str, nargs='+', help='only use the languages with these codes')
+    argparser.add_argument('--glosses', type=str, nargs='+', help='only use these glosses (requires a lexeme database)')
     argparser.add_argument('-t','--times', type=int, default=1, help='the number of times to run the reconstruction')
+    argparser.add_argument('-k', '--n-best', type=int, help='show the k best reconstructions of each set')
     argparser.add_argument('--test', action='store_true', help='test the reconstructions')
+    argparser.add_argument('-p', '--progress', action='store_true', help='show progress, speed and time left')
+    argparser.add_argument('-u', '--unordered', action='store_true', help='print reconstructions as soon as they are done, numbered, instead of in order')
+    argparser.add_argument('--checkpoint', type=str, help='checkpoint file (by default the lexemes file with a .ckpt extension added)')
+    argparser.add_argument('--no-checkpoint', action='store_true', help="don't keep a checkpoint of finished sets")
+    argparser.add_argument('--resume', action='store_true', help='skip the sets that are finished in the checkpoint')
+    argparser.add_argument('--costs', type=str, help='file to keep how long each set took in, to schedule the longest first in later runs')
+    argparser.add_argument('--threshold', type=float, default=0.85, help='similarity ratio (0 to 1) for a reconstruction to pass the test')
     args = argparser.parse_args()
     
-    # globals
-    sp = SegmentParser()
-    lexemesfile = args.lexemesfile
-    lp = FormParser(lexemesfile)
-    forms = lp.forms
-    lang_codes = lp.lang_codes
-    unmatched_symbols = []
-    times = args.times
-    verbose = args.verbose
-    
-    pp = pprint.PrettyPrinter()
-
-    main()
\ No newline at end of file
+    main(args)
@@ -0,0 +1,198 @@
+# handing out cognate sets to worker processes, the ones that take longest first
+# pylexemes
+
+import bisect, hashlib, os, queue
+from warnings import warn
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+COSTS_VERSION = 2
+
+# seconds per unit of each cost feature, until there are observed costs to fit them to
+DEFAULT_WEIGHTS = (1e-4, 3e-6)
+
+# how many observed costs are kept, the oldest are forgotten first
+MAX_OBSERVED = 100000
+
+def set_key(cognate_set):
+    '''A digest of the forms of a cognate set, to recognise it in another run or dataset'''
+    digest = hashlib.md5()
+    for form in sorted(cognate_set, key=lambda form: (str(form.lang_code), str(form))):
+        digest.update('{}:{};'.format(form.lang_code, form).encode('utf-8'))
+    return digest.hexdigest()
+
+def cost_features(cognate_set):
+    '''What the time a set takes depends on: every segment of every form is counted
+    and compared with the reconstruction, and the segments of each group are rearranged
+    against each other, which goes with the square of the group size'''
+    size = len(cognate_set)
+    length = cognate_set.average_len
+    return (size * length, size * size * length)
+
+class CostModel:
+    '''Estimates how long a cognate set takes to reconstruct. Sets that have been done before
+    take what they took then, and the rest are estimated from their cost features
+    with weights fitted (by least squares) to all the costs observed so far.
+    The observed costs are kept in a file, if there is one, for later runs.
+    Every set counts once in the fit, with the last cost it was seen to take.'''
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # set key -> [seconds, f1, f2]
+        self.observed = {}
+        # sums of f1*f1, f1*f2, f2*f2, f1*seconds and f2*seconds over the observed costs, for the fit
+        self.sums = [0.0] * 5
+        self.weights = DEFAULT_WEIGHTS
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                try:
+                    saved = json.load(f)
+                except ValueError:
+                    saved = {}
+            # costs from another version can't be trusted, so they're started over
+            if saved.get('version') == COSTS_VERSION:
+                self.observed = saved['observed']
+                for seconds, f1, f2 in self.observed.values():
+                    self._add(f1, f2, seconds, 1)
+                self.fit()
+
+    def _add(self, f1, f2, seconds, sign):
+        for n, value in enumerate((f1 * f1, f1 * f2, f2 * f2, f1 * seconds, f2 * seconds)):
+            self.sums[n] += sign * value
+
+    def estimate(self, key, features):
+        observed = self.observed.get(key)
+        if observed is not None:
+            return observed[0]
+        return sum(w * f for w, f in zip(self.weights, features))
+
+    def record(self, key, features, seconds):
+        # a set seen before only counts with its latest cost
+        old = self.observed.pop(key, None)
+        if old is not None:
+            self._add(old[1], old[2], old[0], -1)
+        f1, f2 = features
+        self.observed[key] = [seconds, f1, f2]
+        self._add(f1, f2, seconds, 1)
+        if len(self.observed) > MAX_OBSERVED:
+            oldest = next(iter(self.observed))
+            seconds, f1, f2 = self.observed.pop(oldest)
+            self._add(f1, f2, seconds, -1)
+
+    def fit(self):
+        '''Fits the weights to the observed costs, keeping the defaults if there's too little to go on'''
+        s11, s12, s22, s1y, s2y = self.sums
+        det = s11 * s22 - s12 * s12
+        if det > 1e-9 * s11 * s22:
+            w1 = (s22 * s1y - s12 * s2y) / det
+            w2 = (s11 * s2y - s12 * s1y) / det
+            # a cost can't go down as a set grows, so a negative weight means the other feature
+            # explains it all
+            if w1 < 0:
+                w1, w2 = 0.0, s2y / s22
+            elif w2 < 0:
+                w1, w2 = s1y / s11, 0.0
+            self.weights = (w1, w2)
+        elif s11 > 0:
+            # all the sets were alike, so only the overall scale can be told
+            scale = s1y / (DEFAULT_WEIGHTS[0] * s11 + DEFAULT_WEIGHTS[1] * s12)
+            self.weights = tuple(w * scale for w in DEFAULT_WEIGHTS)
+
+    def save(self):
+        '''Keeps the observed costs in the file for later runs. They're only there to make
+        runs faster, so not being able to write them is only worth a warning.'''
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump({'version': COSTS_VERSION, 'observed': self.observed}, f, separators=(',', ':'))
+        except OSError as e:
+            warn('Could not save the costs of the cognate sets to {}: {}'.format(self.filename, e))
+
+class Scheduler:
+    '''Hands out tasks to a pool of workers one by one, the most expensive first,
+    so that a long set never starts last and holds up the end of the run.
+    Only a few more tasks than there are workers are sent ahead, so the order
+    of the rest can still change: every time the number of finished tasks doubles,
+    the weights are fitted again and the tasks left are sorted by the new estimates.
+
+    When the results are wanted in order, going by cost alone would leave the cheap sets
+    near the start for last, and everything after them would have to wait.
+    So with a look-ahead, only the tasks that many places from the first unfinished one
+    are handed out (the most expensive of them first), and the first unfinished one
+    always goes next. No more than that many results ever have to wait for the ones before them.'''
+
+    def __init__(self, model, cognate_sets, in_flight):
+        self.model = model
+        self.cognate_sets = cognate_sets
+        self.in_flight = in_flight
+        self.keys = {}
+        self.features = {}
+
+    def estimate(self, n):
+        if n not in self.keys:
+            self.keys[n] = set_key(self.cognate_sets[n])
+            self.features[n] = cost_features(self.cognate_sets[n])
+        return self.model.estimate(self.keys[n], self.features[n])
+
+    def record(self, n, seconds):
+        self.estimate(n)
+        self.model.record(self.keys[n], self.features[n], seconds)
+
+    def run(self, pool, func, tasks, lookahead=None):
+        '''Runs func on the tasks ({number of the set: task}) in the pool and yields
+        the results as they come. Each result starts with the number of the set
+        and ends with the seconds it took.'''
+        results = queue.Queue()
+        order = sorted(tasks)
+        in_order = lookahead is not None
+        lookahead = max(lookahead, self.in_flight) if in_order else len(order)
+        # the tasks that can be handed out, the most expensive at the end to be popped first
+        remaining = []
+        # the first task in order that isn't finished, and the first one that can't be handed out yet
+        first = 0
+        admitted = 0
+        submitted = set()
+        done = set()
+        running = 0
+        next_sort = 1
+
+        def admit():
+            nonlocal first, admitted
+            while first < len(order) and order[first] in done:
+                first += 1
+            while admitted < len(order) and admitted < first + lookahead:
+                bisect.insort(remaining, order[admitted], key=self.estimate)
+                admitted += 1
+
+        def submit():
+            if in_order and first < len(order) and order[first] not in submitted:
+                n = order[first]
+                remaining.remove(n)
+            else:
+                n = remaining.pop()
+            submitted.add(n)
+            pool.apply_async(func, (tasks[n],), callback=results.put, error_callback=results.put)
+
+        admit()
+        while remaining and running < self.in_flight:
+            submit()
+            running += 1
+        while running:
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            running -= 1
+            done.add(result[0])
+            self.record(result[0], result[-1])
+            if len(done) == next_sort:
+                self.model.fit()
+                remaining.sort(key=self.estimate)
+                next_sort *= 2
+            admit()
+            while remaining and running < self.in_flight:
+                submit()
+                running += 1
+            yield result
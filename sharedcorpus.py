@@ -0,0 +1,83 @@
+# the segment inventory and tokenised corpus in shared memory, for worker processes
+# pylexemes
+
+import struct
+from array import array
+from multiprocessing import shared_memory
+from helpers import SegmentParser
+from corpusfile import CorpusFile, corpus_bytes
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# inventory version, number of segments, length of the metadata
+INVENTORY_HEADER = struct.Struct('<16sII')
+
+def _to_shared_memory(data):
+    block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    block.buf[:len(data)] = data
+    return block
+
+def inventory_bytes(sp):
+    '''The inventory as tables: the feature bitsets of the segments (uint32),
+    then the symbols, names, feature names and diacritics as JSON'''
+    bits = array('I', [sp.feature_bits[symbol] for symbol in sp.symbols])
+    meta = json.dumps({'symbols': sp.symbols, 'names': [sp.names[symbol] for symbol in sp.symbols],
+                       'fields': list(sp.features[sp.symbols[0]]._fields),
+                       'diacritics': sp.diacritic_entries}).encode('utf-8')
+    return INVENTORY_HEADER.pack(sp.version, len(bits), len(meta)) + bits.tobytes() + meta
+
+class SharedCorpus:
+    '''Puts the segment inventory and the compiled corpus into shared memory blocks.
+    Workers attach to them by name, so only the numbers of cognate sets have to be sent to them
+    instead of pickled cognate sets.'''
+
+    def __init__(self, cognate_sets, sp, lang_codes=None, glosses=None):
+        self.corpus_block = _to_shared_memory(corpus_bytes(cognate_sets, sp, lang_codes, glosses))
+        self.inventory_block = _to_shared_memory(inventory_bytes(sp))
+
+    @property
+    def names(self):
+        '''What workers need to attach to the blocks'''
+        return (self.corpus_block.name, self.inventory_block.name)
+
+    def unlink(self):
+        '''Frees the shared memory; call this once the workers are done'''
+        for block in (self.corpus_block, self.inventory_block):
+            block.close()
+            block.unlink()
+
+class AttachedCorpus:
+    '''The worker's side of a SharedCorpus, attached read-only.
+    A worker forked from the process that shared the inventory can pass the parser
+    it inherited as sp, and it's used if it's of the same inventory.
+    Otherwise one is made from the tables, reading the feature bitsets
+    straight from shared memory, which is a lot less than loading the inventory again.'''
+
+    def __init__(self, corpus_name, inventory_name, sp=None):
+        self.corpus_block = shared_memory.SharedMemory(name=corpus_name)
+        self.inventory_block = shared_memory.SharedMemory(name=inventory_name)
+        version, n_segments, meta_len = INVENTORY_HEADER.unpack_from(self.inventory_block.buf, 0)
+        self.sp = sp if sp is not None and sp.version == version else None
+        if self.sp is None:
+            offset = INVENTORY_HEADER.size
+            bits = self.inventory_block.buf[offset:offset + 4 * n_segments].cast('I')
+            offset += 4 * n_segments
+            meta = json.loads(bytes(self.inventory_block.buf[offset:offset + meta_len]).decode('utf-8'))
+            self.sp = SegmentParser.from_tables(meta['symbols'], meta['names'], meta['fields'],
+                                                bits, meta['diacritics'], version)
+            bits.release()
+        # the corpus is only read through views, nothing is copied
+        self.corpus_view = self.corpus_block.buf.toreadonly()
+        self.corpus = CorpusFile(buffer=self.corpus_view, sp=self.sp)
+
+    def cognate_set(self, n):
+        return self.corpus.cognate_set(n)
+
+    def close(self):
+        '''Lets go of the blocks (but leaves them for the process that made them to free)'''
+        self.corpus.close()
+        self.corpus_view.release()
+        for block in (self.corpus_block, self.inventory_block):
+            block.close()
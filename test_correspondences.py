@@ -0,0 +1,31 @@
+# tests for the sound correspondence index
+# pylexemes
+
+import os, tempfile, unittest
+from correspondences import CorrespondenceIndex
+from test_reconstructor import parse_lexemes
+
+class ComposedSegmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lp = parse_lexemes([{'lang_name': 'A', 'lang_code': 'aaa', 'forms': 'pʰata, kaː'},
+                                 {'lang_name': 'B', 'lang_code': 'bbb', 'forms': 'fata, ka'}])
+        self.index = CorrespondenceIndex(self.lp.sp)
+        self.index.add_all(self.lp.forms)
+
+    def test_composed_segments_are_counted(self):
+        self.assertEqual(self.index.count('aaa', 'pʰ', 'bbb', 'f'), 1)
+        self.assertEqual(self.index.count('bbb', 'a', 'aaa', 'aː'), 1)
+        self.assertEqual(self.index.ratio('aaa', 'aː', 'bbb', 'a'), 1.0)
+        self.assertIn(('pʰ', 'f', 1), self.index.correspondences('aaa', 'bbb'))
+
+    def test_composed_segments_are_saved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'index.json')
+            self.index.save(filename)
+            loaded = CorrespondenceIndex.load(filename, self.lp.sp)
+        self.assertEqual(sorted(loaded.correspondences('aaa', 'bbb')),
+                         sorted(self.index.correspondences('aaa', 'bbb')))
+
+if __name__ == '__main__':
+    unittest.main()
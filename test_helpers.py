@@ -0,0 +1,35 @@
+# tests for the helper classes
+# pylexemes
+
+import json, os, tempfile, unittest
+from helpers import FormParser
+
+class SplitFormsTest(unittest.TestCase):
+
+    def test_diacritics_stay_with_their_forms(self):
+        self.assertEqual(FormParser._split_forms("t'a, n̥a, ã, m̩"), ["t'a", 'n̥a', 'ã', 'm̩'])
+
+    def test_missing_forms_and_trailing_comma(self):
+        self.assertEqual(FormParser._split_forms('sunu, -, fot,'), ['sunu', '-', 'fot'])
+
+    def test_lists_are_left_alone(self):
+        self.assertEqual(FormParser._split_forms(["t'a", 'n̥a']), ["t'a", 'n̥a'])
+
+    def test_forms_line_up_in_cognate_sets(self):
+        lexemes = [{'lang_name': 'One', 'lang_code': 'one', 'forms': "t'a, n̥a, sunu"},
+                   {'lang_name': 'Two', 'lang_code': 'two', 'forms': 'ta, na, sunu'}]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'lexemes.json')
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(lexemes, f, ensure_ascii=False)
+            lp = FormParser(filename, store_langs=False)
+        self.assertEqual(len(lp.forms), 3)
+        first = {form.lang_code: form for form in lp.forms[0]}
+        self.assertEqual([segment.symbol for segment in first['one']], ["t'", 'a'])
+        self.assertEqual(str(first['two']), 'ta')
+        second = {form.lang_code: form for form in lp.forms[1]}
+        self.assertEqual([segment.symbol for segment in second['one']], ['n̥', 'a'])
+        self.assertIsNotNone(second['one'].segments[0].features)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+# tests for the language distances and trees
+# pylexemes
+
+import unittest
+import langtree
+from test_reconstructor import parse_lexemes
+
+class DistanceMatrixTest(unittest.TestCase):
+
+    def test_insertions_cost_the_same_anywhere(self):
+        lp = parse_lexemes([{'lang_name': 'A', 'lang_code': 'aaa', 'forms': 'sunu, sunu'},
+                            {'lang_name': 'B', 'lang_code': 'bbb', 'forms': 'sunus, -'},
+                            {'lang_name': 'C', 'lang_code': 'ccc', 'forms': '-, asunu'}])
+        lang_codes, matrix = langtree.distance_matrix(lp.forms, lp.sp)
+        self.assertEqual(lang_codes, ['aaa', 'bbb', 'ccc'])
+        self.assertAlmostEqual(matrix[0][1], 0.2)
+        self.assertAlmostEqual(matrix[0][2], 0.2)
+        # they never have a form in the same set
+        self.assertEqual(matrix[1][2], 1.0)
+
+    def test_no_languages_no_tree(self):
+        self.assertIsNone(langtree.upgma([], []))
+
+if __name__ == '__main__':
+    unittest.main()
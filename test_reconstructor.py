@@ -0,0 +1,62 @@
+# tests for the reconstruction steps
+# pylexemes
+
+import json, os, tempfile, unittest
+import reconstructor
+from helpers import FormParser
+
+def parse_lexemes(lexemes):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'lexemes.json')
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(lexemes, f, ensure_ascii=False)
+        return FormParser(filename, store_langs=False)
+
+class RearrangeTest(unittest.TestCase):
+
+    def setUp(self):
+        # most of the sets have a single form, which leaves groups that rearranging empties
+        self.lp = parse_lexemes([{'lang_name': 'A', 'lang_code': 'aaa', 'forms': 'kakka, aa, ta, tta'},
+                                 {'lang_name': 'B', 'lang_code': 'bbb', 'forms': '-, -, tta, -'}])
+        self.engine = reconstructor.Reconstructor()
+
+    def test_sets_with_single_forms(self):
+        recs = [self.engine.reconstruct_one(cognate_set) for cognate_set in self.lp.forms]
+        self.assertEqual(recs[:2], ['kakka', 'aa'])
+        self.assertTrue(all(isinstance(rec, str) and rec for rec in recs))
+
+    def test_sets_with_single_forms_without_numpy(self):
+        np = reconstructor.np
+        reconstructor.np = None
+        try:
+            self.test_sets_with_single_forms()
+        finally:
+            reconstructor.np = np
+
+    def test_first_group_stays_put(self):
+        # the first group has no previous one, so nothing can be moved from it to the last
+        groups = [reconstructor.group_features(group)
+                    for group in reconstructor.assemble_groups(self.lp.forms[1])]
+        rearranged = reconstructor.rearrange_groups([list(group) for group in groups])
+        self.assertEqual([len(group) for group in rearranged], [1, 1])
+
+    def test_empty_groups_are_passed_through(self):
+        groups = [reconstructor.group_features(group)
+                    for group in reconstructor.assemble_groups(self.lp.forms[1])]
+        dropped = reconstructor.drop_segments([groups[0], [], groups[1]])
+        self.assertEqual(dropped, [groups[0], [], groups[1]])
+
+class TestRecsTest(unittest.TestCase):
+
+    def test_missing_key_forms_are_skipped(self):
+        engine = reconstructor.Reconstructor()
+        tests, result = engine.test_recs(['kakka', 'ta'], ['kakka', '-'])
+        self.assertEqual([test[3] for test in tests], ['passed', 'skipped'])
+        self.assertEqual(result, (100.0, 'success :)'))
+
+    def test_nothing_to_score(self):
+        engine = reconstructor.Reconstructor()
+        self.assertEqual(engine.test_recs(['ta'], ['-']), ([('ta', '-', None, 'skipped')], None))
+
+if __name__ == '__main__':
+    unittest.main()